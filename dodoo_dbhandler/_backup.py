@@ -1,11 +1,60 @@
 # Copyright 2018 ACSONE SA/NV.
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+import io
 import os
+import re
 import shutil
+import sys
+import tarfile
 import tempfile
 import zipfile
 from contextlib import contextmanager
 
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+STORE = "store"
+DEFLATE = "deflate"
+ZSTD = "zstd"
+LZ4 = "lz4"
+ZIP_CODECS = (STORE, DEFLATE)
+TAR_CODECS = (STORE, ZSTD, LZ4)
+# frame signatures of the tar codecs, to read archives of any codec
+CODEC_MAGIC = {b"(\xb5/\xfd": ZSTD, b"\x04\x22\x4d\x18": LZ4}
+
+# signatures of file formats which are already compressed
+COMPRESSED_MAGIC = (
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG",  # png
+    b"GIF8",  # gif
+    b"%PDF",  # pdf
+    b"PK\x03\x04",  # zip, office documents
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf",  # 7z
+    b"(\xb5/\xfd",  # zstd
+    b"\x04\x22\x4d\x18",  # lz4
+)
+
+
+def is_compressed(path):
+    """Tell whether the file at path is in a compressed format, so
+    compressing it again would be a waste of time."""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    if head[4:8] == b"ftyp":  # mp4, mov, heic
+        return True
+    return head.startswith(COMPRESSED_MAGIC)
+
 
 class AbstractBackup(object):
     """Abstract class with methods to open, read, write, close,
@@ -43,6 +92,21 @@ class AbstractBackup(object):
         """
         raise NotImplementedError()  # pragma: no cover
 
+    def localpath(self, arcname):
+        """Return the local path of arcname, for tools writing into the
+        backup by themselves.
+
+        :param arcname: the path into the backup
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def extractall(self, dest):
+        """Extract the backup into the dest folder.
+
+        :param dest: the folder to extract to
+        """
+        raise NotImplementedError()  # pragma: no cover
+
     def close(self):
         """Close the backup
         """
@@ -58,12 +122,39 @@ class ZipBackup(AbstractBackup):
 
     format = "zip"
 
-    def __init__(self, path, mode):
+    def __init__(self, path, mode, codec=DEFLATE, level=None):
+        """
+        :param codec: "deflate", or "store" for no compression
+        :param level: the deflate compression level, from 0 to 9, on
+                      python >= 3.7 only, the zlib default otherwise
+        """
         super(ZipBackup, self).__init__(path, mode)
+        if codec not in ZIP_CODECS:
+            raise Exception(
+                "Codec {} not supported by zip backups. Available codecs: {}".format(
+                    codec, "|".join(ZIP_CODECS)
+                )
+            )
+        if codec == STORE:
+            self._compression = zipfile.ZIP_STORED
+        else:
+            self._compression = zipfile.ZIP_DEFLATED
+        options = {}
+        if level is not None and sys.version_info >= (3, 7):
+            options["compresslevel"] = level
         self._zipFile = zipfile.ZipFile(
-            self._path, self._mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True
+            self._path,
+            self._mode,
+            compression=self._compression,
+            allowZip64=True,
+            **options
         )
 
+    def _compress_type(self, filename):
+        if self._compression != zipfile.ZIP_STORED and is_compressed(filename):
+            return zipfile.ZIP_STORED
+        return None  # the default compression of the archive
+
     def addtree(self, src, arcname):
         len_prefix = len(src) + 1
         for dirpath, _dirnames, filenames in os.walk(src):
@@ -71,16 +162,24 @@ class ZipBackup(AbstractBackup):
                 path = os.path.normpath(os.path.join(dirpath, fname))
                 if os.path.isfile(path):
                     _arcname = os.path.join(arcname, path[len_prefix:])
-                    self._zipFile.write(path, _arcname)
+                    self.addfile(path, _arcname)
 
     def addfile(self, filename, arcname):
-        self._zipFile.write(filename, arcname)
+        self._zipFile.write(
+            filename, arcname, compress_type=self._compress_type(filename)
+        )
 
     def write(self, stream, arcname):
-        with tempfile.NamedTemporaryFile() as f:
+        if sys.version_info < (3, 6):
+            # zip members can only be written from files before python 3.6
+            with tempfile.NamedTemporaryFile() as f:
+                shutil.copyfileobj(stream, f)
+                f.flush()
+                self._zipFile.write(f.name, arcname)
+            return
+        # stream straight into the archive, the size is not known upfront
+        with self._zipFile.open(arcname, "w", force_zip64=True) as f:
             shutil.copyfileobj(stream, f)
-            f.seek(0)
-            self._zipFile.write(f.name, arcname)
 
     def close(self):
         self._zipFile.close()
@@ -110,6 +209,9 @@ class FolderBackup(AbstractBackup):
         with open(os.path.join(self._path, arcname), "wb") as f:
             shutil.copyfileobj(stream, f)
 
+    def localpath(self, arcname):
+        return os.path.join(self._path, arcname)
+
     def close(self):
         pass
 
@@ -117,11 +219,183 @@ class FolderBackup(AbstractBackup):
         shutil.rmtree(self._path)
 
 
-BACKUP_FORMAT = {ZipBackup.format: ZipBackup, FolderBackup.format: FolderBackup}
+class TarBackup(AbstractBackup):
+    """Tar archive compressed as a whole with zstd, on jobs threads,
+    or lz4. The archive is written and read sequentially, so it can be
+    streamed to or from a pipe, or stdout and stdin with the "-" path.
+
+    Streams are added as members of at most CHUNK_SIZE bytes named
+    arcname.partNNNNNN, their size having to be known before they are
+    written. They are joined back on extraction.
+    """
+
+    format = "tar"
+    CHUNK_SIZE = 64 * 1024 * 1024
+    PART_RE = re.compile(r"^(.*)\.part(\d{6})$")
+
+    def __init__(self, path, mode, codec=ZSTD, level=None, jobs=None):
+        """
+        :param codec: "zstd", "lz4", or "store" for no compression, only
+                      used for writing, the codec being detected on reading
+        :param level: the compression level of the codec
+        :param jobs: the number of zstd compression threads, all cores
+                     by default
+        """
+        super(TarBackup, self).__init__(path, mode)
+        if mode not in ("r", "w"):
+            raise Exception("Tar backups can only be read or written")
+        if codec not in TAR_CODECS:
+            raise Exception(
+                "Codec {} not supported by tar backups. Available codecs: {}".format(
+                    codec, "|".join(TAR_CODECS)
+                )
+            )
+        if mode == "w":
+            self._check_codec(codec)
+        self._fileobj, self._own_fileobj = self._open()
+        if mode == "w":
+            self._stream = self._compressor(codec, level, jobs)
+        else:
+            self._stream = self._decompressor()
+        self._tarFile = tarfile.open(fileobj=self._stream, mode=mode + "|")
+
+    def _open(self):
+        """Return the (file object, opened by us) to read or write"""
+        if self._path == "-":
+            std = sys.stdout if self._mode == "w" else sys.stdin
+            # python 2 standard streams are binary already
+            return getattr(std, "buffer", std), False
+        if hasattr(self._path, "read") or hasattr(self._path, "write"):
+            return self._path, False
+        return open(self._path, self._mode + "b"), True
+
+    def _check_codec(self, codec):
+        if codec == ZSTD and zstandard is None:
+            raise Exception("zstd backups require the zstandard package")
+        if codec == LZ4 and lz4 is None:
+            raise Exception("lz4 backups require the lz4 package")
+
+    def _compressor(self, codec, level, jobs):
+        if codec == ZSTD:
+            cctx = zstandard.ZstdCompressor(
+                level=3 if level is None else level,
+                threads=-1 if jobs is None else jobs,
+            )
+            return cctx.stream_writer(self._fileobj, closefd=False)
+        if codec == LZ4:
+            return lz4.frame.LZ4FrameFile(
+                self._fileobj, "wb", compression_level=level or 0
+            )
+        return self._fileobj
+
+    def _decompressor(self):
+        # the input may not be seekable: read its head, and read it again
+        head = self._fileobj.read(4)
+        codec = CODEC_MAGIC.get(head, STORE)
+        self._check_codec(codec)
+        self._fileobj = _PrefixedReader(head, self._fileobj)
+        if codec == ZSTD:
+            dctx = zstandard.ZstdDecompressor()
+            return dctx.stream_reader(self._fileobj, closefd=False)
+        if codec == LZ4:
+            return lz4.frame.LZ4FrameFile(self._fileobj, "rb")
+        return self._fileobj
+
+    def addtree(self, src, arcname):
+        self._tarFile.add(src, arcname)
+
+    def addfile(self, filename, arcname):
+        self._tarFile.add(filename, arcname)
+
+    def write(self, stream, arcname):
+        index = 0
+        while True:
+            chunk = stream.read(self.CHUNK_SIZE)
+            # an empty stream still gets a part
+            if not chunk and index:
+                break
+            info = tarfile.TarInfo("{}.part{:06d}".format(arcname, index))
+            info.size = len(chunk)
+            self._tarFile.addfile(info, io.BytesIO(chunk))
+            index += 1
+
+    def _extract_path(self, dest, name):
+        path = os.path.normpath(os.path.join(dest, name))
+        if os.path.isabs(name) or not path.startswith(os.path.join(dest, "")):
+            raise Exception("Refusing to extract {} outside of {}".format(name, dest))
+        return path
+
+    def extractall(self, dest):
+        dest = os.path.abspath(dest)
+        for member in self._tarFile:
+            if member.isdir():
+                path = self._extract_path(dest, member.name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                continue
+            if not member.isfile():
+                continue  # backups only hold directories and files
+            name, index = member.name, 0
+            match = self.PART_RE.match(name)
+            if match:
+                name, index = match.group(1), int(match.group(2))
+            path = self._extract_path(dest, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # parts come in order, each one following the previous one
+            with open(path, "ab" if index else "wb") as f:
+                shutil.copyfileobj(self._tarFile.extractfile(member), f)
+
+    def close(self):
+        self._tarFile.close()
+        if self._stream is not self._fileobj:
+            self._stream.close()
+        if self._own_fileobj:
+            self._fileobj.close()
+        elif self._mode == "w":
+            self._fileobj.flush()
+
+    def delete(self):
+        try:
+            self.close()
+        finally:
+            if self._own_fileobj and self._mode == "w":
+                os.unlink(self._path)
+
+
+class _PrefixedReader(object):
+    """ Read head, then the rest of fileobj """
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._fileobj.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._fileobj.read(), b""
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        if len(data) < size:
+            data += self._fileobj.read(size - len(data))
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+BACKUP_FORMAT = {
+    ZipBackup.format: ZipBackup,
+    FolderBackup.format: FolderBackup,
+    TarBackup.format: TarBackup,
+}
 
 
 @contextmanager
-def backup(format, path, mode):
+def backup(format, path, mode, **options):
+    """Open a backup of the given format, passing options such as
+    the codec to the backup class."""
     backup_class = BACKUP_FORMAT.get(format)
     if not backup_class:  # pragma: no cover
         raise Exception(
@@ -129,7 +403,7 @@ def backup(format, path, mode):
                 format, "|".join(BACKUP_FORMAT.keys())
             )
         )
-    _backup = backup_class(path, mode)
+    _backup = backup_class(path, mode, **options)
     try:
         yield _backup
         _backup.close()
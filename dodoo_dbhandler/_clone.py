@@ -0,0 +1,150 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import logging
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dodoo import odoo
+from psycopg2.extensions import quote_ident
+
+from . import _profiling
+from ._dbutils import database_size, pg_connect
+from ._filestore import link_filestore
+
+_logger = logging.getLogger(__name__)
+
+AUTO = "auto"
+# CREATE DATABASE ... TEMPLATE with the default strategy of the server
+TEMPLATE = "template"
+# CREATE DATABASE ... TEMPLATE ... STRATEGY, postgres >= 15
+FILE_COPY = "file_copy"
+WAL_LOG = "wal_log"
+# pg_dump | pg_restore into a new empty database, for when the source
+# cannot be used as a template, as it has active connections
+DUMP = "dump"
+CLONE_ENGINES = (AUTO, TEMPLATE, FILE_COPY, WAL_LOG, DUMP)
+
+# postgres >= 15 copies templates block by block through the WAL by
+# default, which is only faster than copying files for small templates
+WAL_LOG_MAX_SIZE = 32 * 1024 * 1024
+
+
+def _has_strategy(cr):
+    return cr.connection.server_version >= 150000
+
+
+def select_engine(cr, template, engine=AUTO):
+    """ Return the clone engine to use to copy template """
+    if engine in (FILE_COPY, WAL_LOG) and not _has_strategy(cr):
+        # previous versions always copy files
+        return TEMPLATE
+    if engine != AUTO:
+        return engine
+    if not _has_strategy(cr):
+        return TEMPLATE
+    if database_size(cr, template) <= WAL_LOG_MAX_SIZE:
+        return WAL_LOG
+    return FILE_COPY
+
+
+def _create_database(cr, dbname, template, encoding=None, strategy=None):
+    query = "CREATE DATABASE {} TEMPLATE {}".format(
+        quote_ident(dbname, cr.connection), quote_ident(template, cr.connection)
+    )
+    if encoding:
+        query += " ENCODING '{}'".format(encoding)
+    if strategy:
+        query += " STRATEGY {}".format(strategy.upper())
+    cr.execute(query)
+
+
+def _dump_restore(cr, dbname, template, encoding=None):
+    _create_database(cr, dbname, "template0", encoding)
+    try:
+        _pipe_dump_restore(dbname, template)
+    except Exception:
+        cr.execute("DROP DATABASE {}".format(quote_ident(dbname, cr.connection)))
+        raise
+
+
+def _pipe_dump_restore(dbname, template):
+    env = odoo.tools.misc.exec_pg_environ()
+    dump = subprocess.Popen(
+        [odoo.tools.find_pg_tool("pg_dump"), "--format=c", "--no-owner", template],
+        env=env,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        restore = subprocess.Popen(
+            [
+                odoo.tools.find_pg_tool("pg_restore"),
+                "--no-owner",
+                "--exit-on-error",
+                "--dbname",
+                dbname,
+            ],
+            env=env,
+            stdin=dump.stdout,
+        )
+    except Exception:
+        dump.kill()
+        dump.wait()
+        raise
+    finally:
+        # let pg_dump receive SIGPIPE if pg_restore exits
+        dump.stdout.close()
+    # wait for both, so neither is left behind
+    returncodes = [restore.wait(), dump.wait()]
+    if any(returncodes):
+        raise subprocess.CalledProcessError(
+            next(r for r in returncodes if r), "pg_dump | pg_restore"
+        )
+
+
+def clone_database(cr, template, dbname, engine=AUTO, encoding=None):
+    """ Create dbname as a copy of template with the given clone engine,
+    and return the engine used.
+
+    cr must be in autocommit mode, and connected to another database
+    than template. Unless the engine is dump, template must have no
+    active connection.
+    """
+    engine = select_engine(cr, template, engine)
+    _logger.debug("Cloning %s into %s with engine %s", template, dbname, engine)
+    with _profiling.span("clone {} ({})".format(dbname, engine)) as span:
+        if engine == DUMP:
+            _dump_restore(cr, dbname, template, encoding)
+        elif engine == TEMPLATE:
+            _create_database(cr, dbname, template, encoding)
+        else:
+            _create_database(cr, dbname, template, encoding, engine)
+        if _profiling.enabled():
+            span.add(bytes=database_size(cr, dbname))
+    return engine
+
+
+def _clone_db(source, dest, engine, encoding):
+    start = time.time()
+    with pg_connect() as cr:
+        clone_database(cr, source, dest, engine, encoding)
+    link_filestore(source, dest)
+    _logger.info("Database {} ready in {:.1f}s.".format(dest, time.time() - start))
+
+
+def clone_databases(source, dests, jobs, engine=AUTO, encoding=None):
+    """ Clone database source and its filestore into dests, jobs at a time.
+
+    The filestores are hardlinked to the filestore of source.
+    """
+    if not dests:
+        return
+    # make sure no connection prevents using source as a template
+    odoo.sql_db.close_db(source)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [
+            executor.submit(_clone_db, source, dest, engine, encoding) for dest in dests
+        ]
+        for future in futures:
+            future.result()
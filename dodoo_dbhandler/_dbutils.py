@@ -28,6 +28,18 @@ def db_exists(dbname):
         return bool(cr.fetchone())
 
 
+def existing_databases(dbnames):
+    """ Return the lowercased names of the databases of dbnames which
+    exist, in one catalog query """
+    with pg_connect() as cr:
+        cr.execute(
+            "SELECT lower(datname) FROM pg_catalog.pg_database "
+            "WHERE lower(datname) = ANY(%s)",
+            ([dbname.lower() for dbname in dbnames],),
+        )
+        return {r[0] for r in cr.fetchall()}
+
+
 def terminate_connections(dbname):
     with pg_connect() as cr:
         cr.execute(
@@ -37,3 +49,8 @@ def terminate_connections(dbname):
             "AND pid <> pg_backend_pid();",
             (dbname,),
         )
+
+
+def database_size(cr, dbname):
+    cr.execute("SELECT pg_database_size(%s)", (dbname,))
+    return cr.fetchone()[0]
@@ -0,0 +1,71 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+
+class EvictionPolicy(object):
+    """ Abstract eviction policy of cache templates.
+
+    A policy orders the rows of the template catalog from the most
+    to the least worth keeping, so templates are evicted from the end.
+    """
+
+    name = None
+
+    def order_by(self):
+        """ Return an SQL ORDER BY expression over the catalog columns.
+
+        It may use the %(now)s parameter, the current UTC time.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+
+class LruPolicy(EvictionPolicy):
+    """ Keep the most recently used templates """
+
+    name = "lru"
+
+    def order_by(self):
+        return "last_used DESC"
+
+
+class LfuPolicy(EvictionPolicy):
+    """ Keep the most frequently used templates """
+
+    name = "lfu"
+
+    def order_by(self):
+        return "hit_count DESC, last_used DESC"
+
+
+class CostPolicy(EvictionPolicy):
+    """ Keep the templates that would take the most time to rebuild,
+    weighted by their hit count and decayed by the hours since they
+    were last used.
+    """
+
+    name = "cost"
+
+    def order_by(self):
+        return """
+            COALESCE(build_duration, 0) * (hit_count + 1)
+            / (EXTRACT(EPOCH FROM %(now)s - last_used) / 3600 + 1) DESC,
+            last_used DESC
+        """
+
+
+EVICTION_POLICIES = {
+    LruPolicy.name: LruPolicy,
+    LfuPolicy.name: LfuPolicy,
+    CostPolicy.name: CostPolicy,
+}
+
+
+def eviction_policy(name):
+    policy_class = EVICTION_POLICIES.get(name)
+    if not policy_class:  # pragma: no cover
+        raise Exception(
+            "Eviction policy {} not supported. Available policies: {}".format(
+                name, "|".join(EVICTION_POLICIES.keys())
+            )
+        )
+    return policy_class()
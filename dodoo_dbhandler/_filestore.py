@@ -0,0 +1,188 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import errno
+import fcntl
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from dodoo import odoo
+
+from . import _profiling
+
+# linux ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+AUTO = "auto"
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+PARALLEL = "parallel"
+COPY = "copy"
+FILESTORE_MODES = (AUTO, HARDLINK, REFLINK, PARALLEL, COPY)
+DEFAULT_JOBS = 8
+
+
+def filestore_path(dbname):
+    return odoo.tools.config.filestore(dbname)
+
+
+def reflink(src, dest):
+    """ Copy src to dest sharing their data blocks, if the file system
+    supports it, or raise OSError """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            fdest.close()
+            os.unlink(dest)
+            raise
+    shutil.copystat(src, dest)
+
+
+def _reflink_or_copy(src, dest):
+    try:
+        reflink(src, dest)
+    except (IOError, OSError):
+        shutil.copy2(src, dest)
+
+
+def _walk_files(src, dest):
+    """ Create the directories of src in dest, and yield the
+    (source, destination) paths of the files to copy """
+    for dirpath, _dirnames, filenames in os.walk(src):
+        destpath = os.path.join(dest, os.path.relpath(dirpath, src))
+        if not os.path.isdir(destpath):
+            os.makedirs(destpath)
+        for filename in filenames:
+            destfile = os.path.join(destpath, filename)
+            if not os.path.lexists(destfile):
+                yield os.path.join(dirpath, filename), destfile
+
+
+def _same_device(src, dest):
+    parent = dest
+    while not os.path.exists(parent):
+        parent = os.path.dirname(parent)
+    return os.stat(src).st_dev == os.stat(parent).st_dev
+
+
+def select_mode(src, dest, mode=AUTO):
+    """ Return the mode to use to copy the tree src to dest """
+    if mode != AUTO:
+        return mode
+    if _same_device(src, dest):
+        return HARDLINK
+    return PARALLEL
+
+
+class CopyStopped(Exception):
+    """ Raised when a copy is stopped by its stop event """
+
+
+def _check_stop(stop):
+    if stop is not None and stop.is_set():
+        raise CopyStopped("Copy stopped")
+
+
+def _copy_file_unless_stopped(stop, srcfile, destfile):
+    _check_stop(stop)
+    return shutil.copy2(srcfile, destfile)
+
+
+def copy_tree(src, dest, mode=AUTO, jobs=DEFAULT_JOBS, stop=None):
+    """ Recreate the directory tree src in dest and return the
+    (mode, bytes, files) used and copied.
+
+    Modes are hardlink (the default on the same file system), reflink
+    (sharing data blocks on copy-on-write file systems), parallel (jobs
+    threads copying files, the default across file systems), and copy.
+
+    Filestore files are named after their content and never modified
+    in place, so they can be shared. Files are reflinked, or copied
+    as a last resort, when they cannot be hardlinked (different file
+    systems, too many links...), and copied when they cannot be
+    reflinked.
+
+    The copy raises CopyStopped as soon as the stop event, if any, is
+    set, leaving the files already copied behind.
+    """
+    mode = select_mode(src, dest, mode)
+    size = files = 0
+    if mode == PARALLEL:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [
+                executor.submit(_copy_file_unless_stopped, stop, srcfile, destfile)
+                for srcfile, destfile in _walk_files(src, dest)
+            ]
+            for future in futures:
+                size += os.path.getsize(future.result())
+                files += 1
+    else:
+        copy_file = {HARDLINK: os.link, REFLINK: _reflink_or_copy}.get(
+            mode, shutil.copy2
+        )
+        for srcfile, destfile in _walk_files(src, dest):
+            _check_stop(stop)
+            try:
+                copy_file(srcfile, destfile)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+                copy_file = _reflink_or_copy
+                copy_file(srcfile, destfile)
+            size += os.path.getsize(destfile)
+            files += 1
+    return mode, size, files
+
+
+def link_tree_incremental(src, dest, previous):
+    """ Recreate the directory tree src in dest, hardlinking the files
+    found in the tree previous with the same relative path and size,
+    and copying the other ones. Return the (linked, copied, bytes
+    copied) counts.
+
+    Filestore files are named after their content, so a file with the
+    same name and size is the same file.
+    """
+    linked = copied = size = 0
+    for srcfile, destfile in _walk_files(src, dest):
+        prevfile = os.path.join(previous, os.path.relpath(srcfile, src))
+        try:
+            if os.path.getsize(prevfile) == os.path.getsize(srcfile):
+                os.link(prevfile, destfile)
+                linked += 1
+                continue
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+        shutil.copy2(srcfile, destfile)
+        copied += 1
+        size += os.path.getsize(destfile)
+    return linked, copied, size
+
+
+def link_filestore(source, dest):
+    """ Materialize the filestore of database source, if any, as the
+    filestore of database dest """
+    src = filestore_path(source)
+    if not os.path.isdir(src):
+        return
+    with _profiling.span("link filestore {}".format(dest)) as span:
+        _mode, size, files = copy_tree(src, filestore_path(dest), HARDLINK)
+        span.add(bytes=size, files=files)
+
+
+def rename_filestore(source, dest):
+    src = filestore_path(source)
+    if os.path.isdir(src):
+        os.rename(src, filestore_path(dest))
+
+
+def drop_filestore(dbname):
+    shutil.rmtree(filestore_path(dbname), ignore_errors=True)
+
+
+def filestore_size(dbname):
+    """ Return the size in bytes of the filestore of dbname """
+    return _profiling.tree_size(filestore_path(dbname))[0]
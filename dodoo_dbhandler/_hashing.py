@@ -0,0 +1,125 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# files modified less than this many seconds ago are hashed but not
+# remembered, as a later change within the same mtime granularity
+# would go unnoticed
+RACY_DELAY = 2
+
+# atomic on POSIX, as os.replace which python 2 lacks
+_replace = getattr(os, "replace", os.rename)
+
+CHUNK_SIZE = 1024 * 1024
+
+# all algorithms must produce 20 bytes digests, so hashsums
+# fit in template names
+HASH_ALGORITHMS = ("sha1",)
+if hasattr(hashlib, "blake2b"):  # python >= 3.6
+    HASH_ALGORITHMS += ("blake2b",)
+
+
+def new_hash(algorithm="sha1"):
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.new(algorithm)
+
+
+def update_from_file(h, filepath):
+    """ Feed the content of filepath into h in fixed-size chunks """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filepath, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+
+
+def file_digest(filepath, algorithm="sha1"):
+    h = new_hash(algorithm)
+    update_from_file(h, filepath)
+    return h.hexdigest()
+
+
+class FingerprintCache(object):
+    """ Persistent store of per-file digests.
+
+    Entries are keyed by file path and are only reused as long as the
+    (size, mtime in ns, inode) stat data of the file did not change,
+    so unchanged files are not read again.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = self._load()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            return {}
+        return data.get("entries", {})
+
+    def digest(self, filepath, algorithm="sha1"):
+        """ Return the digest of filepath, reading it only if needed.
+
+        This method is thread safe.
+        """
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        # st_mtime_ns is python 3 only
+        key = [st.st_size, int(st.st_mtime * 1e9), st.st_ino]
+        with self._lock:
+            entry = self._entries.get(filepath)
+            if entry and entry[:3] == key and algorithm in entry[3]:
+                self.hits += 1
+                return entry[3][algorithm]
+            self.misses += 1
+        digest = file_digest(filepath, algorithm)
+        if time.time() - st.st_mtime >= RACY_DELAY:
+            with self._lock:
+                entry = self._entries.get(filepath)
+                if not entry or entry[:3] != key:
+                    entry = self._entries[filepath] = key + [{}]
+                entry[3][algorithm] = digest
+                self._dirty = True
+        return digest
+
+    def save(self):
+        """ Write the store to disk, forgetting files that vanished """
+        for filepath in list(self._entries):
+            if not os.path.exists(filepath):
+                del self._entries[filepath]
+                self._dirty = True
+        if not self._dirty:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.VERSION, "entries": self._entries}, f)
+        _replace(tmp_path, self.path)
+        self._dirty = False
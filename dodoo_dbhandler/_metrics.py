@@ -0,0 +1,146 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+from __future__ import division
+
+import contextlib
+import json
+import os
+import time
+
+from . import _profiling
+
+# phases of an init run, which may overlap: for instance the clone
+# of a new template is part of the build
+PHASES = ("hash", "lookup", "clone", "build", "refresh", "trim")
+
+MISS_NEW_HASH = "new_hash"
+MISS_EVICTED = "evicted"
+MISS_NEW_MODULE_SET = "new_module_set"
+MISS_REASONS = (MISS_NEW_HASH, MISS_EVICTED, MISS_NEW_MODULE_SET)
+
+# atomic on POSIX, as os.replace which python 2 lacks
+_replace = getattr(os, "replace", os.rename)
+
+
+class Metrics(object):
+    """ Metrics of a run of init, written as a JSON line and/or as
+    a Prometheus textfile collector file. """
+
+    def __init__(self, prefix=None):
+        self.values = {
+            "timestamp": time.time(),
+            "prefix": prefix,
+            "hit": None,
+            "miss_reason": None,
+            "template_size": None,
+            "template_build_duration": None,
+            "time_saved": None,
+        }
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """ Add the time spent in this context to phase, which is also
+        profiled as a span """
+        start = time.time()
+        try:
+            with _profiling.span(phase):
+                yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.0) + (time.time() - start)
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def as_dict(self):
+        res = dict(self.values)
+        res["timings"] = dict(self.timings)
+        return res
+
+    def write_json(self, path):
+        """ Append the metrics as one JSON line to path """
+        line = json.dumps(self.as_dict(), sort_keys=True) + "\n"
+        # a single write in append mode, so concurrent runs do not
+        # interleave their lines
+        with open(path, "a") as f:
+            f.write(line)
+
+    def _prometheus_lines(self):
+        labels = 'prefix="{}"'.format(self.values["prefix"] or "")
+        gauges = [
+            ("hit", "1 if the template cache was hit, 0 otherwise."),
+            ("template_size", "Size in bytes of the template used."),
+            ("time_saved", "Estimated seconds saved by the template cache."),
+            ("timestamp", "Unix time of the run."),
+        ]
+        for key, doc in gauges:
+            value = self.values[key]
+            if value is None:
+                continue
+            name = "dodoo_init_{}".format(key)
+            yield "# HELP {} {}".format(name, doc)
+            yield "# TYPE {} gauge".format(name)
+            yield "{}{{{}}} {}".format(name, labels, float(value))
+        name = "dodoo_init_miss_reason"
+        yield "# HELP {} 1 for the reason of the template cache miss.".format(name)
+        yield "# TYPE {} gauge".format(name)
+        for reason in MISS_REASONS:
+            yield '{}{{{},reason="{}"}} {}'.format(
+                name, labels, reason, float(self.values["miss_reason"] == reason)
+            )
+        name = "dodoo_init_phase_seconds"
+        yield "# HELP {} Seconds spent in each phase.".format(name)
+        yield "# TYPE {} gauge".format(name)
+        for phase in PHASES:
+            yield '{}{{{},phase="{}"}} {}'.format(
+                name, labels, phase, self.timings.get(phase, 0.0)
+            )
+
+    def write_prometheus(self, path):
+        """ Write the metrics of the last run to path, in the format
+        of the Prometheus node exporter textfile collector """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            for line in self._prometheus_lines():
+                f.write(line + "\n")
+        # the collector must never read a partially written file
+        _replace(tmp_path, path)
+
+
+def read_json(path):
+    """ Yield the metrics recorded in path, skipping invalid lines """
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def aggregate(records):
+    """ Summarize metrics records as a dict """
+    res = {
+        "runs": 0,
+        "hits": 0,
+        "misses": 0,
+        "miss_reasons": dict.fromkeys(MISS_REASONS, 0),
+        "time_saved": 0.0,
+        "timings": dict.fromkeys(PHASES, 0.0),
+    }
+    for record in records:
+        if record.get("hit") is None:
+            continue  # no database created
+        res["runs"] += 1
+        if record["hit"]:
+            res["hits"] += 1
+        else:
+            res["misses"] += 1
+            reason = record.get("miss_reason")
+            if reason:
+                res["miss_reasons"][reason] = res["miss_reasons"].get(reason, 0) + 1
+        res["time_saved"] += record.get("time_saved") or 0.0
+        for phase, duration in record.get("timings", {}).items():
+            res["timings"][phase] = res["timings"].get(phase, 0.0) + duration
+    res["hit_ratio"] = res["hits"] / res["runs"] if res["runs"] else None
+    return res
@@ -0,0 +1,211 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import hashlib
+
+from dodoo import odoo
+from psycopg2.extras import Json
+
+from utils.manifest import get_manifest_path, read_manifest
+
+# ir_module_module columns set from manifests, as done by
+# ir.module.module.update_list(), with their default values
+MODULE_FIELDS = (
+    ("shortdesc", "name", ""),
+    ("summary", "summary", ""),
+    ("author", "author", "Unknown"),
+    ("maintainer", "maintainer", None),
+    ("website", "website", ""),
+    ("license", "license", "LGPL-3"),
+    ("sequence", "sequence", 100),
+    ("application", "application", False),
+    ("auto_install", "auto_install", False),
+    ("url", "url", ""),
+)
+
+
+def modules_fingerprint():
+    """ Return a checksum of the modules found in the addons path
+    and of their manifests """
+    h = hashlib.sha1()
+    for module_name in sorted(odoo.modules.module.get_modules()):
+        module_path = odoo.modules.get_module_path(module_name)
+        manifest_path = get_manifest_path(module_path)
+        h.update(module_name.encode("utf8"))
+        with open(manifest_path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _read_manifests():
+    res = {}
+    for module_name in odoo.modules.module.get_modules():
+        module_path = odoo.modules.get_module_path(module_name)
+        if module_path:
+            res[module_name] = read_manifest(module_path)
+    return res
+
+
+def _module_values(manifest):
+    res = {}
+    for column, key, default in MODULE_FIELDS:
+        value = manifest.get(key, default)
+        if column == "auto_install":
+            # may be a list of dependencies triggering the installation
+            value = value is not False
+        res[column] = value or default
+    return res
+
+
+def _columns(cr, table):
+    """ Return a {column: data type} dict """
+    cr.execute(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_name = %s",
+        (table,),
+    )
+    return dict(cr.fetchall())
+
+
+def _to_db(value, data_type):
+    if data_type == "jsonb":  # translated field, Odoo >= 16
+        return Json({"en_US": value})
+    return value
+
+
+def _from_db(value, data_type):
+    if data_type == "jsonb" and value:
+        return value.get("en_US")
+    return value
+
+
+def _read_links(cr, table, column=None):
+    """ Return a {module_id: {name: value of column}} dict of the
+    rows of table """
+    columns = ["module_id", "name"] + ([column] if column else [])
+    cr.execute("SELECT {} FROM {}".format(", ".join(columns), table))
+    res = {}
+    for r in cr.fetchall():
+        res.setdefault(r[0], {})[r[1]] = r[2] if column else None
+    return res
+
+
+def _sync_links(cr, table, module_id, links, current, column=None):
+    """ Make the rows of table linked to module_id match links, a
+    {name: value of column} dict. Return True if rows changed. """
+    if current.get(module_id, {}) == links:
+        return False
+    cr.execute("DELETE FROM {} WHERE module_id = %s".format(table), (module_id,))
+    columns = ["name"] + ([column] if column else [])
+    for name, value in links.items():
+        cr.execute(
+            "INSERT INTO {} (module_id, {}) VALUES (%s, {})".format(
+                table, ", ".join(columns), ", ".join(["%s"] * len(columns))
+            ),
+            (module_id, name) + ((value,) if column else ()),
+        )
+    return True
+
+
+def _insert_module(cr, module_name, state, values, columns):
+    names = ["name", "state"] + list(values)
+    params = [module_name, state] + [_to_db(v, columns[c]) for c, v in values.items()]
+    cr.execute(
+        """
+        INSERT INTO ir_module_module ({}, create_date, write_date)
+        VALUES ({}, now() at time zone 'UTC', now() at time zone 'UTC')
+        RETURNING id
+    """.format(
+            ", ".join(names), ", ".join(["%s"] * len(names))
+        ),
+        params,
+    )
+    module_id = cr.fetchone()[0]
+    cr.execute(
+        """
+        INSERT INTO ir_model_data (name, module, model, res_id, noupdate)
+        VALUES (%s, 'base', 'ir.module.module', %s, true)
+    """,
+        ("module_" + module_name, module_id),
+    )
+    return module_id
+
+
+def sync_module_list(cr):
+    """ Update the ir_module_module table from the manifests of the
+    modules found in the addons path, with SQL only.
+
+    This does like ir.module.module.update_list() without loading
+    the registry, except module categories are left unchanged.
+    Return the number of modules (updated, added).
+    """
+    columns = _columns(cr, "ir_module_module")
+    fields = [c for c, _, _ in MODULE_FIELDS if c in columns]
+    cr.execute(
+        "SELECT name, id, state, {} FROM ir_module_module".format(", ".join(fields))
+    )
+    existing = {r[0]: r[1:] for r in cr.fetchall()}
+    if "auto_install_required" in _columns(cr, "ir_module_module_dependency"):
+        dependency_column = "auto_install_required"  # Odoo >= 14
+    else:
+        dependency_column = None
+    dependencies = _read_links(cr, "ir_module_module_dependency", dependency_column)
+    if _columns(cr, "ir_module_module_exclusion"):  # Odoo >= 12
+        exclusions = _read_links(cr, "ir_module_module_exclusion")
+    else:
+        exclusions = None
+    updated = added = 0
+    for module_name, manifest in sorted(_read_manifests().items()):
+        values = _module_values(manifest)
+        values = {c: values[c] for c in fields}
+        installable = manifest.get("installable", True)
+        if module_name not in existing:
+            state = "uninstalled" if installable else "uninstallable"
+            module_id = _insert_module(cr, module_name, state, values, columns)
+            added += 1
+            changed = True
+        else:
+            row = existing[module_name]
+            module_id, state, old_values = row[0], row[1], row[2:]
+            changes = {}
+            for c, old in zip(fields, old_values):
+                v, old = values[c], _from_db(old, columns[c])
+                if (v or old) and v != old:
+                    changes[c] = v
+            if installable and state == "uninstallable":
+                changes["state"] = "uninstalled"
+            if changes:
+                cr.execute(
+                    "UPDATE ir_module_module SET {}, "
+                    "write_date = now() at time zone 'UTC' WHERE id = %s".format(
+                        ", ".join("{} = %s".format(c) for c in changes)
+                    ),
+                    [_to_db(v, columns.get(c)) for c, v in changes.items()]
+                    + [module_id],
+                )
+            changed = bool(changes)
+        depends = manifest.get("depends", [])
+        if dependency_column:
+            auto_install = manifest.get("auto_install")
+            links = {
+                d: not isinstance(auto_install, list) or d in auto_install
+                for d in depends
+            }
+        else:
+            links = dict.fromkeys(depends)
+        changed |= _sync_links(
+            cr,
+            "ir_module_module_dependency",
+            module_id,
+            links,
+            dependencies,
+            dependency_column,
+        )
+        if exclusions is not None:
+            links = dict.fromkeys(manifest.get("excludes", []))
+            changed |= _sync_links(
+                cr, "ir_module_module_exclusion", module_id, links, exclusions
+            )
+        if changed and module_name in existing:
+            updated += 1
+    return updated, added
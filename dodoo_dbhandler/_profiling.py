@@ -0,0 +1,215 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import contextlib
+import cProfile
+import functools
+import os
+import threading
+import time
+
+import click
+
+WORK = "work"
+LOCK = "lock"
+
+
+class Span(object):
+    def __init__(self, name, kind, depth, thread):
+        self.name = name
+        self.kind = kind
+        self.depth = depth
+        self.thread = thread
+        self.start = time.time()
+        self.duration = None
+        self.counters = {}
+
+    def add(self, **counters):
+        """ Add bytes, rows or any other count to the span """
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _NullSpan(object):
+    def add(self, **counters):
+        pass
+
+
+class Profiler(object):
+    """ Record the steps of a command as timed spans, and optionally
+    profile its Python code with cProfile.
+
+    Spans waiting for a lock are reported apart from work spans.
+    """
+
+    def __init__(self, pstats_path=None):
+        self.pstats_path = pstats_path
+        self.spans = []
+        self.start = None
+        self.duration = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cprofile = None
+
+    def __enter__(self):
+        self.start = time.time()
+        if self.pstats_path:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._cprofile:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.pstats_path)
+        self.duration = time.time() - self.start
+
+    @contextlib.contextmanager
+    def span(self, name, kind=WORK, **counters):
+        depth = getattr(self._local, "depth", 0)
+        span = Span(name, kind, depth, threading.current_thread().name)
+        span.add(**counters)
+        with self._lock:
+            self.spans.append(span)
+        self._local.depth = depth + 1
+        try:
+            yield span
+        finally:
+            self._local.depth = depth
+            span.duration = time.time() - span.start
+
+    def lock_wait(self):
+        """ Return the total time spent waiting for locks """
+        return sum(s.duration or 0.0 for s in self.spans if s.kind == LOCK)
+
+    def report(self):
+        lines = [
+            "{:<50} {:>10} {:>12} {:>10} {:>8}  {}".format(
+                "span", "seconds", "bytes", "rows", "files", "thread"
+            )
+        ]
+        for span in self.spans:
+            name = "  " * span.depth + span.name
+            if span.kind == LOCK:
+                name += " [lock]"
+            lines.append(
+                "{:<50} {:>10.3f} {:>12} {:>10} {:>8}  {}".format(
+                    name,
+                    span.duration or 0.0,
+                    span.counters.get("bytes", ""),
+                    span.counters.get("rows", ""),
+                    span.counters.get("files", ""),
+                    span.thread,
+                )
+            )
+        duration = self.duration or 0.0
+        lock_wait = self.lock_wait()
+        lines.append("")
+        lines.append("total: {:.3f}s".format(duration))
+        lines.append("lock wait: {:.3f}s".format(lock_wait))
+        lines.append("work: {:.3f}s".format(duration - lock_wait))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, "w") as f:
+            f.write(self.report())
+
+
+_profiler = None
+
+
+@contextlib.contextmanager
+def profile(path, pstats_path=None):
+    """ Profile the steps run in this context, writing the span report
+    to path and the cProfile statistics to pstats_path. Nothing is
+    recorded without path nor pstats_path. """
+    global _profiler
+    if not path and not pstats_path:
+        yield None
+        return
+    _profiler = Profiler(pstats_path)
+    try:
+        with _profiler:
+            yield _profiler
+    finally:
+        profiler, _profiler = _profiler, None
+        if path:
+            profiler.write(path)
+
+
+def enabled():
+    return _profiler is not None
+
+
+@contextlib.contextmanager
+def span(name, **counters):
+    """ Time the step run in this context, if profiling """
+    if _profiler is None:
+        yield _NullSpan()
+    else:
+        with _profiler.span(name, **counters) as s:
+            yield s
+
+
+@contextlib.contextmanager
+def lock_wait(name):
+    """ Time the wait for a lock in this context, if profiling """
+    if _profiler is None:
+        yield _NullSpan()
+    else:
+        with _profiler.span(name, kind=LOCK) as s:
+            yield s
+
+
+def tree_size(path):
+    """ Return the (bytes, files) counts of a directory tree """
+    size = files = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                continue
+            files += 1
+    return size, files
+
+
+class CountingReader(object):
+    """ Wrap a file object, counting the bytes read from it in span """
+
+    def __init__(self, stream, span):
+        self._stream = stream
+        self._span = span
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        self._span.add(bytes=len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def profile_options(f):
+    """ Add the --profile and --profile-pstats options to a command,
+    profiling it accordingly """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with profile(kwargs.pop("profile"), kwargs.pop("profile_pstats")):
+            return f(*args, **kwargs)
+
+    wrapper = click.option(
+        "--profile-pstats",
+        type=click.Path(dir_okay=False),
+        help="Profile the Python code of the command with cProfile and "
+        "write the statistics to FILE, to be read with the pstats module.",
+    )(wrapper)
+    wrapper = click.option(
+        "--profile",
+        type=click.Path(dir_okay=False),
+        help="Write to FILE a report of the time spent in each step of the "
+        "command, with the bytes and rows processed. Time spent waiting "
+        "for locks is reported apart from work time.",
+    )(wrapper)
+    return wrapper
@@ -3,46 +3,168 @@
 # Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
+from __future__ import division
+
+import io
 import json
+import logging
+import multiprocessing
 import os
+import re
 import shutil
-import tempfile
+import subprocess
+from datetime import datetime
 
 import click
 import dodoo
 from dodoo import odoo
 from snapshotter import snapshotter
 
-from ._backup import backup as do_backup
+from . import _profiling
+from ._backup import STORE, TAR_CODECS, backup as do_backup
 from ._dbutils import db_exists
+from ._filestore import link_tree_incremental
+
+_logger = logging.getLogger(__name__)
+
+PLAIN = "plain"
+CUSTOM = "custom"
+DIRECTORY = "directory"
+# pg_dump formats, with the name of their file in the backup
+DUMP_FILES = {PLAIN: "dump.sql", CUSTOM: "db.dump", DIRECTORY: "db.dir"}
+# named like snapshotter's, so they are rotated together
+SNAPSHOT_RE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}_\d{2}_\d{2}\.snapshot$")
 
 
 def _latest_snapshot(path):
     return os.path.join(path, "latest.snapshot")
 
 
-def _dump_db(dbname, _backup):
+def _snapshot_date():
+    return datetime.now().strftime("%Y-%m-%dT%H_%M_%S")
+
+
+def _ls_snapshots(path):
+    """ Return the snapshot directories in path, oldest first """
+    return sorted(
+        os.path.join(path, name)
+        for name in os.listdir(path)
+        if SNAPSHOT_RE.match(name) and os.path.isdir(os.path.join(path, name))
+    )
+
+
+def _dump_format(_backup, dump_format=CUSTOM):
+    if _backup.format == "zip":
+        return PLAIN  # like Odoo zip backups
+    if _backup.format != "folder" and dump_format == DIRECTORY:
+        return CUSTOM  # pg_dump writes directories in local folders only
+    return dump_format
+
+
+def _dump_db_directory(dbname, _backup, jobs):
+    path = _backup.localpath(DUMP_FILES[DIRECTORY])
+    cmd = [
+        odoo.tools.find_pg_tool("pg_dump"),
+        "--schema=public",
+        "--no-owner",
+        "--format=directory",
+        "--jobs={}".format(max(jobs, 1)),
+        "--file={}".format(path),
+        dbname,
+    ]
+    with _profiling.span("pg_dump") as span:
+        subprocess.check_call(cmd, env=odoo.tools.misc.exec_pg_environ())
+        if _profiling.enabled():
+            size, files = _profiling.tree_size(path)
+            span.add(bytes=size, files=files)
+
+
+def _dump_db(dbname, _backup, dump_format=CUSTOM, jobs=1):
+    dump_format = _dump_format(_backup, dump_format)
+    if dump_format == DIRECTORY:
+        _dump_db_directory(dbname, _backup, jobs)
+        return
     cmd = ["pg_dump", "--schema=public", "--no-owner", dbname]
-    filename = "dump.sql"
-    if _backup.format == "folder":
+    if dump_format == CUSTOM:
         cmd.insert(-1, "--format=c")
-        filename = "db.dump"
-    _stdin, stdout = odoo.tools.exec_pg_command_pipe(*cmd)
-    _backup.write(stdout, filename)
+    with _profiling.span("pg_dump") as span:
+        _stdin, stdout = odoo.tools.exec_pg_command_pipe(*cmd)
+        _backup.write(_profiling.CountingReader(stdout, span), DUMP_FILES[dump_format])
 
 
-def _create_manifest(cr, dbname, _backup):
-    manifest = odoo.service.db.dump_db_manifest(cr)
-    with tempfile.NamedTemporaryFile(mode="w") as f:
-        json.dump(manifest, f, indent=4)
-        f.seek(0)
-        _backup.addfile(f.name, "manifest.json")
+def _create_manifest(cr, dbname, _backup, dump_format=CUSTOM):
+    with _profiling.span("manifest"):
+        manifest = odoo.service.db.dump_db_manifest(cr)
+    # tell restores how to read the dump, possibly in parallel
+    dump_format = _dump_format(_backup, dump_format)
+    manifest["dump_format"] = dump_format
+    manifest["dump_file"] = DUMP_FILES[dump_format]
+    data = json.dumps(manifest, indent=4).encode("utf8")
+    _backup.write(io.BytesIO(data), "manifest.json")
 
 
 def _backup_filestore(dbname, _backup):
     filestore_source = odoo.tools.config.filestore(dbname)
     if os.path.isdir(filestore_source):
-        _backup.addtree(filestore_source, "filestore")
+        with _profiling.span("backup filestore") as span:
+            _backup.addtree(filestore_source, "filestore")
+            if _profiling.enabled():
+                size, files = _profiling.tree_size(filestore_source)
+                span.add(bytes=size, files=files)
+
+
+def _link_filestore(dbname, dest, previous):
+    """ Write the filestore of dbname in the dest snapshot, hardlinking
+    the files unchanged since the previous snapshot """
+    filestore_source = odoo.tools.config.filestore(dbname)
+    if not os.path.isdir(filestore_source):
+        return
+    with _profiling.span("link filestore") as span:
+        linked, copied, size = link_tree_incremental(
+            filestore_source,
+            os.path.join(dest, "filestore"),
+            os.path.join(previous, "filestore"),
+        )
+        span.add(bytes=size, files=copied)
+    _logger.info(
+        "Filestore snapshot: {} files linked, {} files copied ({:.1f} MB).".format(
+            linked, copied, size / 1024 / 1024
+        )
+    )
+
+
+def _direct_snapshot(db, dbname, dest, dump_format, dump_jobs):
+    """ Write a new snapshot of dbname directly in the dest snapshots
+    directory, then rotate the snapshots like snapshotter does """
+    incomplete = os.path.join(dest, "incomplete.snapshot")
+    # left by an interrupted snapshot
+    shutil.rmtree(incomplete, ignore_errors=True)
+    os.makedirs(incomplete)
+    with do_backup("folder", incomplete, "w") as _backup, db.cursor() as cr:
+        _create_manifest(cr, dbname, _backup, dump_format)
+        _link_filestore(dbname, incomplete, _latest_snapshot(dest))
+        _dump_db(dbname, _backup, dump_format, dump_jobs)
+    name = "{}.snapshot".format(_snapshot_date())
+    os.rename(incomplete, os.path.join(dest, name))
+    # replace the latest symlink atomically
+    latest = _latest_snapshot(dest)
+    if os.path.lexists(latest + ".new"):
+        os.unlink(latest + ".new")
+    os.symlink(name, latest + ".new")
+    os.rename(latest + ".new", latest)
+
+
+def _rotate_snapshots(dest, min_snapshots, max_snapshots):
+    with _profiling.span("rotate snapshots"):
+        snapshots = _ls_snapshots(dest)
+        while len(snapshots) > max(max_snapshots, min_snapshots):
+            shutil.rmtree(snapshots.pop(0))
+
+
+def _write_backup(cr, dbname, _backup, dump_format, dump_jobs):
+    _create_manifest(cr, dbname, _backup, dump_format)
+    _backup_filestore(dbname, _backup)
+    _dump_db(dbname, _backup, dump_format, dump_jobs)
 
 
 @click.command(cls=dodoo.CommandWithOdooEnv)
@@ -66,13 +188,69 @@ def _backup_filestore(dbname, _backup):
     show_default=True,
     help="Create destination directory unless it's abent",
 )
+@click.option(
+    "--dump-format",
+    type=click.Choice([CUSTOM, DIRECTORY]),
+    default=CUSTOM,
+    show_default=True,
+    help="pg_dump format: a single custom format file, or a directory "
+    "dumped with --dump-jobs concurrent jobs, which can also be "
+    "restored in parallel with pg_restore --jobs.",
+)
+@click.option(
+    "--dump-jobs",
+    type=int,
+    help="Number of tables to dump concurrently with the directory format. "
+    "Defaults to the number of cores.",
+)
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Write the snapshot as a tar archive to DEST, a file or - for "
+    "stdout, sequentially and without temporary files, instead of "
+    "maintaining snapshots in the DEST directory.",
+)
+@click.option(
+    "--codec",
+    type=click.Choice(TAR_CODECS),
+    help="Compression of the tar archive written with --stream, none by "
+    "default. zstd and lz4 require the zstandard and lz4 packages. "
+    "Archives are read back whatever their compression.",
+)
+@click.option(
+    "--level",
+    type=int,
+    help="Compression level of --codec, 3 for zstd and 0 for lz4 by default.",
+)
+@click.option(
+    "--direct",
+    is_flag=True,
+    help="Write the snapshot directly in DEST instead of staging it in "
+    "a temporary directory and copying it with rsync. Filestore files "
+    "with the same name and size as in the latest snapshot are "
+    "hardlinked to it, and only new ones are copied.",
+)
 @click.argument("dbname", nargs=1)
 @click.argument("dest", nargs=1, required=1)
-def snapshot(env, min_snapshots, max_snapshots, unless_absent, dbname, dest):
+@_profiling.profile_options
+def snapshot(
+    env,
+    min_snapshots,
+    max_snapshots,
+    unless_absent,
+    dump_format,
+    dump_jobs,
+    stream,
+    codec,
+    level,
+    direct,
+    dbname,
+    dest,
+):
     """ Create an Odoo database snapshot from an existing one.
 
-    This script dumps the database using pg_dump.
-    It also copies the filestore.
+    This script dumps the database using pg_dump, possibly in
+    parallel (see --dump-format). It also copies the filestore.
 
     Unlike Odoo, this script allows you to make a backup of a
     database without going through the web interface. This
@@ -85,15 +263,37 @@ def snapshot(env, min_snapshots, max_snapshots, unless_absent, dbname, dest):
     change. This can save a lot of disk space and bandwith
     especially for filestore items.
 
+    With --direct, the snapshot is written in place instead, and
+    only the new filestore files are copied.
+
+    With --stream, a single snapshot is written as a tar archive
+    instead, which can be piped to other tools.
+
     (TBD) You can define a ssh destination.
 
     """
-    if not shutil.which("rsync"):
-        msg = "rsync binary not found in path."
-        raise click.ClickException(msg)
     if not db_exists(dbname):
         msg = "Database does not exist: {}".format(dbname)
         raise click.ClickException(msg)
+    dump_jobs = dump_jobs or multiprocessing.cpu_count()
+    if (codec or level is not None) and not stream:
+        msg = "--codec and --level require --stream"
+        raise click.ClickException(msg)
+    if stream and direct:
+        msg = "--stream and --direct cannot be used together"
+        raise click.ClickException(msg)
+    if stream:
+        db = odoo.sql_db.db_connect(dbname)
+        try:
+            options = {"codec": codec or STORE, "level": level}
+            with do_backup("tar", dest, "w", **options) as _backup, db.cursor() as cr:
+                _write_backup(cr, dbname, _backup, dump_format, dump_jobs)
+        finally:
+            odoo.sql_db.close_db(dbname)
+        return
+    if not direct and not shutil.which("rsync"):
+        msg = "rsync binary not found in path."
+        raise click.ClickException(msg)
     if not os.path.exists(dest) and unless_absent:
         msg = "Destination does not exist: {}".format(dest)
         raise click.ClickException(msg)
@@ -104,12 +304,18 @@ def snapshot(env, min_snapshots, max_snapshots, unless_absent, dbname, dest):
         raise click.ClickException(msg)
     db = odoo.sql_db.db_connect(dbname)
     try:
+        if direct:
+            dest = os.path.abspath(dest)
+            _direct_snapshot(db, dbname, dest, dump_format, dump_jobs)
+            _rotate_snapshots(dest, min_snapshots, max_snapshots)
+            return
         with odoo.tools.osutil.tempdir() as temp_dir:
             with do_backup("folder", temp_dir, "w") as _backup, db.cursor() as cr:
-                _create_manifest(cr, dbname, _backup)
-                _backup_filestore(dbname, _backup)
-                _dump_db(dbname, _backup)
-            snapshotter.snapshot(temp_dir, dest, False, min_snapshots, max_snapshots)
+                _write_backup(cr, dbname, _backup, dump_format, dump_jobs)
+            with _profiling.span("rsync snapshot"):
+                snapshotter.snapshot(
+                    temp_dir, dest, False, min_snapshots, max_snapshots
+                )
     finally:
         odoo.sql_db.close_db(dbname)
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import json
+
+import click
+import dodoo
+
+from ._dbutils import pg_connect
+from ._metrics import aggregate, read_json
+from .initializer import DbCache
+
+
+def catalog_stats(prefix=None):
+    """ Summarize the template catalog per prefix """
+    with pg_connect() as cr:
+        cr.execute("SELECT to_regclass(%s)", (DbCache.CATALOG,))
+        if not cr.fetchone()[0]:
+            return {}
+        cr.execute(
+            """
+            SELECT prefix, count(*), sum(size), sum(hit_count),
+                   sum(build_duration),
+                   sum(build_duration * hit_count)
+            FROM {}
+            WHERE %(prefix)s IS NULL OR prefix = %(prefix)s
+            GROUP BY prefix
+            ORDER BY prefix
+        """.format(
+                DbCache.CATALOG
+            ),
+            {"prefix": prefix},
+        )
+        return {
+            r[0]: {
+                "templates": r[1],
+                "size": r[2] or 0,
+                "hits": r[3] or 0,
+                "build_duration": r[4] or 0.0,
+                # hits of templates whose build duration is unknown
+                # do not count
+                "time_saved": r[5] or 0.0,
+            }
+            for r in cr.fetchall()
+        }
+
+
+def _echo_stats(title, stats):
+    click.secho(title, bold=True)
+    for key, value in sorted(stats.items()):
+        if isinstance(value, dict):
+            value = ", ".join("{}={}".format(k, v) for k, v in sorted(value.items()))
+        elif isinstance(value, float):
+            value = "{:.1f}".format(value)
+        click.echo("  {}: {}".format(key, value))
+
+
+@click.command(cls=dodoo.CommandWithOdooEnv)
+@click.option(
+    "--cache-prefix",
+    help="Only report the cache templates having this prefix. "
+    "By default, all prefixes are reported.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Also aggregate the metrics of the runs recorded in FILE "
+    "with the init --metrics-file option.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Output the statistics as JSON.")
+def cachestats(env, cache_prefix, metrics_file, as_json):
+    """ Report the effectiveness of the init template cache.
+
+    Statistics per prefix (number and size of templates, hits, build
+    durations and estimated time saved) are computed from the template
+    catalog. Hit ratio, miss reasons and time spent per phase are
+    aggregated from the metrics file of init, if provided.
+    """
+    res = {"catalog": catalog_stats(cache_prefix)}
+    if metrics_file:
+        records = read_json(metrics_file)
+        if cache_prefix:
+            records = (r for r in records if r.get("prefix") == cache_prefix)
+        res["runs"] = aggregate(records)
+    if as_json:
+        click.echo(json.dumps(res, indent=2, sort_keys=True))
+        return
+    for prefix, stats in sorted(res["catalog"].items()):
+        _echo_stats("Templates of prefix {}".format(prefix), stats)
+    if metrics_file:
+        _echo_stats("Runs", res["runs"])
+
+
+if __name__ == "__main__":  # pragma: no cover
+    cachestats()
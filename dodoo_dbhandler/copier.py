@@ -3,29 +3,221 @@
 # Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
+from __future__ import division
+
+import functools
+import hashlib
+import logging
 import os
 import shutil
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from datetime import timedelta
 
 import click
 import dodoo
 from dodoo import odoo
-from psycopg2.extensions import AsIs, quote_ident
+from psycopg2.extensions import quote_ident
 
-from ._dbutils import db_exists, pg_connect, terminate_connections
+from utils.manifest import expand_dependencies
 
+from . import _profiling
+from ._clone import AUTO, CLONE_ENGINES, DUMP, clone_database, clone_databases
+from ._dbutils import existing_databases, pg_connect, terminate_connections
+from ._filestore import DEFAULT_JOBS, FILESTORE_MODES, copy_tree
+from .initializer import DbCache, addons_hash
 
-def _copy_db(cr, source, dest):
-    cr.execute(
-        "CREATE DATABASE %s WITH TEMPLATE %s",
-        (AsIs(quote_ident(dest, cr)), AsIs(quote_ident(source, cr))),
-    )
+_logger = logging.getLogger(__name__)
+
+# how long to wait for another process copying the same derived database
+CACHE_BUILD_TIMEOUT = 3600
+
+
+def _copy_db(cr, source, dest, engine=AUTO):
+    clone_database(cr, source, dest, engine)
 
 
-def _copy_filestore(source, dest):
+def _copy_filestore(source, dest, mode=AUTO, jobs=DEFAULT_JOBS, stop=None):
     filestore_source = odoo.tools.config.filestore(source)
     if os.path.isdir(filestore_source):
         filestore_dest = odoo.tools.config.filestore(dest)
-        shutil.copytree(filestore_source, filestore_dest)
+        start = time.time()
+        with _profiling.span("copy filestore") as span:
+            mode, size, files = copy_tree(
+                filestore_source, filestore_dest, mode, jobs, stop
+            )
+            span.add(bytes=size, files=files)
+        duration = max(time.time() - start, 1e-6)
+        _logger.info(
+            "Filestore copied with mode {}: {} files, {:.1f} MB in {:.1f}s "
+            "({:.1f} MB/s, {:.0f} files/s).".format(
+                mode,
+                files,
+                size / 1024 / 1024,
+                duration,
+                size / 1024 / 1024 / duration,
+                files / duration,
+            )
+        )
+
+
+def _copy_db_thread(source, dest, engine, backend_pids):
+    with pg_connect() as cr:
+        backend_pids.append(cr.connection.get_backend_pid())
+        _copy_db(cr, source, dest, engine)
+
+
+def _cancel_db_copy(db_future, backend_pids):
+    """ Cancel the database copy, again and again until it is over, as
+    it may not have started yet """
+    with pg_connect() as cr:
+        while not db_future.done():
+            for pid in backend_pids:
+                cr.execute("SELECT pg_cancel_backend(%s)", (pid,))
+            wait([db_future], timeout=0.5)
+
+
+def _rollback_copy(dest, drop_db, filestore_existed):
+    _logger.warning("Copy failed, rolling back {}".format(dest))
+    if drop_db:
+        with pg_connect() as cr:
+            cr.execute("DROP DATABASE IF EXISTS {}".format(quote_ident(dest, cr)))
+    if not filestore_existed:
+        shutil.rmtree(odoo.tools.config.filestore(dest), ignore_errors=True)
+
+
+def _copy_db_and_filestore(source, dest, engine, filestore_mode, filestore_jobs):
+    """ Copy the database and the filestore concurrently, as the first
+    one mostly keeps the postgres server busy, and the second one the
+    local disks. If either copy fails, both are rolled back. """
+    filestore_existed = os.path.exists(odoo.tools.config.filestore(dest))
+    backend_pids = []
+    stop_filestore = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        db_future = executor.submit(_copy_db_thread, source, dest, engine, backend_pids)
+        filestore_future = executor.submit(
+            _copy_filestore,
+            source,
+            dest,
+            filestore_mode,
+            filestore_jobs,
+            stop_filestore,
+        )
+        wait([db_future, filestore_future], return_when=FIRST_EXCEPTION)
+        # no need to wait for the end of the other copy
+        if db_future.done() and db_future.exception():
+            stop_filestore.set()
+        if filestore_future.done() and filestore_future.exception():
+            _cancel_db_copy(db_future, backend_pids)
+    errors = [f.exception() for f in (db_future, filestore_future) if f.exception()]
+    if errors:
+        # a failed database copy leaves no database behind, and dest
+        # may have been created by someone else meanwhile
+        _rollback_copy(dest, not db_future.exception(), filestore_existed)
+        raise errors[0]
+
+
+def _missing_modules(dbname, module_names):
+    """ Return the modules of module_names which are not installed in
+    database dbname """
+    try:
+        with pg_connect(dbname) as cr:
+            if not odoo.modules.db.is_initialized(cr):
+                return sorted(module_names)
+            cr.execute(
+                "SELECT name FROM ir_module_module "
+                "WHERE state IN ('installed', 'to upgrade') AND name = ANY(%s)",
+                (list(module_names),),
+            )
+            installed = {r[0] for r in cr.fetchall()}
+    finally:
+        # let dbname be used as a template
+        odoo.sql_db.close_db(dbname)
+    return sorted(module_names - installed)
+
+
+def _install_modules(dbname, module_names):
+    module_names = expand_dependencies(module_names)
+    missing = _missing_modules(dbname, module_names)
+    skipped = len(module_names) - len(missing)
+    if not missing:
+        click.secho(
+            "All {} modules already installed.".format(skipped), fg="green", bold=True
+        )
+        return
+    odoo.tools.config["init"] = dict.fromkeys(missing, 1)
+    if odoo.release.version_info[0] < 10:
+        Registry = odoo.modules.registry.RegistryManager
+    else:
+        Registry = odoo.modules.registry.Registry
+    with _profiling.span("registry load {}".format(dbname)):
+        Registry.new(dbname, force_demo=False, update_module=True)
+    odoo.sql_db.close_db(dbname)
+    click.secho(
+        "{} modules installed, {} already installed! ✨ 🍰 ✨".format(
+            len(missing), skipped
+        ),
+        fg="green",
+        bold=True,
+    )
+
+
+def derived_hashsum(source, source_version, module_names):
+    """ Return a checksum identifying the copy of source, in the state
+    identified by source_version, with module_names and their
+    dependencies installed """
+    h = hashlib.sha1()
+    h.update("!source={}!".format(source).encode("utf8"))
+    h.update("!version={}!".format(source_version).encode("utf8"))
+    h.update(addons_hash(module_names, False).encode("utf8"))
+    return h.hexdigest()
+
+
+def _copy_and_install(
+    source,
+    dest,
+    force_disconnect,
+    clone_engine,
+    filestore_mode,
+    filestore_jobs,
+    module_names,
+):
+    if force_disconnect and clone_engine != DUMP:
+        with _profiling.span("terminate connections"):
+            terminate_connections(source)
+    _copy_db_and_filestore(source, dest, clone_engine, filestore_mode, filestore_jobs)
+    if module_names:
+        _install_modules(dest, module_names)
+
+
+def _copy_from_cache(dbcache, dest, hashsum, build):
+    """ Create dest from the cached derived database matching hashsum,
+    or build it with build() and add it to the cache """
+    hit = dbcache.create(dest, hashsum)
+    if not hit:
+        with dbcache.build_lock(hashsum, CACHE_BUILD_TIMEOUT):
+            # another process may have built it meanwhile
+            hit = dbcache.create(dest, hashsum)
+            if not hit:
+                start = time.time()
+                build()
+                dbcache.add(dest, hashsum, build_duration=time.time() - start)
+    if hit:
+        click.secho("Found matching derived database! ✨ 🍰 ✨", fg="green", bold=True)
+
+
+def _check_databases(source, dests):
+    if len({dest.lower() for dest in dests}) != len(dests):
+        raise click.ClickException("Duplicate destination database names")
+    existing = existing_databases([source] + dests)
+    if source.lower() not in existing:
+        msg = "Source database does not exist: {}".format(source)
+        raise click.ClickException(msg)
+    for dest in dests:
+        if dest.lower() in existing:
+            msg = "Destination database already exists: {}".format(dest)
+            raise click.ClickException(msg)
 
 
 @click.command(cls=dodoo.CommandWithOdooEnv)
@@ -35,49 +227,176 @@ def _copy_filestore(source, dest):
     is_flag=True,
     help="Attempt to disconnect users from the template database.",
 )
+@click.option(
+    "--clone-engine",
+    type=click.Choice(CLONE_ENGINES),
+    default=AUTO,
+    show_default=True,
+    help="How to copy the database: with CREATE DATABASE TEMPLATE and "
+    "the default strategy of the server (template), the FILE_COPY or "
+    "WAL_LOG strategies of PostgreSQL >= 15, or pg_dump and pg_restore "
+    "(dump), which does not require disconnecting users from the "
+    "source database. By default, WAL_LOG is used for small databases "
+    "and FILE_COPY for the other ones when available.",
+)
+@click.option(
+    "--filestore-mode",
+    type=click.Choice(FILESTORE_MODES),
+    default=AUTO,
+    show_default=True,
+    help="How to copy the filestore: with hardlinks, which is safe as "
+    "Odoo never modifies filestore files in place, with reflinks on "
+    "copy-on-write file systems, by copying files in parallel, or "
+    "with a plain copy. By default, hardlinks are used when the "
+    "destination is on the same file system, and parallel copy "
+    "otherwise.",
+)
+@click.option(
+    "--filestore-jobs",
+    default=DEFAULT_JOBS,
+    show_default=True,
+    type=int,
+    help="Number of files to copy concurrently with the parallel filestore mode.",
+)
+@click.option(
+    "--dest",
+    "dests",
+    multiple=True,
+    help="Additional destination database. Can be repeated. Additional "
+    "destinations are cloned from DEST once it is ready, modules "
+    "installed and raw sql applied, and share its filestore through "
+    "hardlinks.",
+)
+@click.option(
+    "--copy-jobs",
+    default=4,
+    show_default=True,
+    type=int,
+    help="Number of additional destinations to clone concurrently.",
+)
 @click.option(
     "--modules",
     "-m",
     show_default=True,
     help="Comma separated list of addons to install.",
 )
+@click.option(
+    "--cache/--no-cache",
+    default=False,
+    show_default=True,
+    help="Keep the copy of the source database with the --modules "
+    "installed as a cache template, and clone it directly in later runs "
+    "with the same source state, modules and addons content. Requires "
+    "--modules and --source-version. The cache is trimmed with "
+    "--cache-max-size and --cache-max-age, dropping the least recently "
+    "used templates first: init's --cache-eviction and --cache-max-bytes "
+    "are not available.",
+)
+@click.option(
+    "--cache-prefix",
+    default="copy",
+    show_default=True,
+    help="Prefix to use when naming cache template databases "
+    "(max 8 characters). CAUTION: all databases named like "
+    "{prefix}-____________-% will eventually be dropped "
+    "by the cache control mechanism, so choose the "
+    "prefix wisely.",
+)
+@click.option(
+    "--cache-max-age",
+    default=30,
+    show_default=True,
+    type=int,
+    help="Drop cache templates that have not been used for "
+    "more than N days. Use -1 to disable.",
+)
+@click.option(
+    "--cache-max-size",
+    default=5,
+    show_default=True,
+    type=int,
+    help="Keep N most recently used cache templates. "
+    "Use -1 to disable. Use 0 to empty cache.",
+)
+@click.option(
+    "--source-version",
+    help="Tag identifying the state of the source database in the cache, "
+    "required with --cache. Postgres does not tell when a database was "
+    "last written to, so the cache cannot detect changes of the source by "
+    "itself: the tag must change whenever the source does, for instance "
+    "the date of the production dump it was restored from.",
+)
 @click.argument("source", required=True)
 @click.argument("dest", required=True)
 @click.argument("rawsql", required=False)
-def copy(env, source, dest, force_disconnect, modules, rawsql):
+@_profiling.profile_options
+def copy(
+    env,
+    source,
+    dest,
+    force_disconnect,
+    clone_engine,
+    filestore_mode,
+    filestore_jobs,
+    dests,
+    copy_jobs,
+    modules,
+    cache,
+    cache_prefix,
+    cache_max_age,
+    cache_max_size,
+    source_version,
+    rawsql,
+):
     """ Create an Odoo database by copying an existing one.
 
-    This script copies using postgres CREATEDB WITH TEMPLATE.
-    It also copies the filestore.
-    """
-    with pg_connect() as cr:
-        if db_exists(dest):
-            msg = "Destination database already exists: {}".format(dest)
-            raise click.ClickException(msg)
-        if not db_exists(source):
-            msg = "Source database does not exist: {}".format(source)
-            raise click.ClickException(msg)
-        if force_disconnect:
-            terminate_connections(source)
-        _copy_db(cr, source, dest)
-    _copy_filestore(source, dest)
+    This script copies using postgres CREATEDB WITH TEMPLATE,
+    or pg_dump and pg_restore (see --clone-engine).
+    It also copies the filestore, while the database is copied.
 
-    module_names = [m.strip() for m in modules.split(",")]
-    if module_names:
-        odoo.tools.config["init"] = dict.fromkeys(module_names, 1)
-        if odoo.release.version_info[0] < 10:
-            Registry = odoo.modules.registry.RegistryManager
-        else:
-            Registry = odoo.modules.registry.Registry
-        Registry.new(dest, force_demo=False, update_module=True)
-        odoo.sql_db.close_db(dest)
-        click.secho("Additional modules loaded! ✨ 🍰 ✨", fg="green", bold=True)
+    Additional destinations (see --dest) are cloned from the first
+    copy rather than from the source, so the source is only read once.
+
+    With --cache and --modules, the copy with the modules installed
+    is cached, like init caches database templates.
+    """
+    module_names = [m.strip() for m in (modules or "").split(",") if m.strip()]
+    if cache and not module_names:
+        raise click.ClickException("--cache requires --modules")
+    if cache and not source_version:
+        raise click.ClickException("--cache requires --source-version")
+    _check_databases(source, [dest] + list(dests))
+    build = functools.partial(
+        _copy_and_install,
+        source,
+        dest,
+        force_disconnect,
+        clone_engine,
+        filestore_mode,
+        filestore_jobs,
+        module_names,
+    )
+    if cache:
+        with DbCache(cache_prefix, clone_engine=clone_engine) as dbcache:
+            hashsum = derived_hashsum(source, source_version, module_names)
+            _copy_from_cache(dbcache, dest, hashsum, build)
+            if cache_max_size >= 0:
+                dbcache.trim_size(cache_max_size)
+            if cache_max_age >= 0:
+                dbcache.trim_age(timedelta(days=cache_max_age))
+    else:
+        build()
 
     if rawsql:
-        with pg_connect(dest) as cr:
+        with pg_connect(dest) as cr, _profiling.span("raw sql") as span:
             cr.execute(rawsql)
+            span.add(rows=max(cr.rowcount, 0))
             click.secho("RAW sql statment loaded! ✨ 🍰 ✨", fg="green", bold=True)
 
+    if dests:
+        with _profiling.span("clone destinations"):
+            clone_databases(dest, list(dests), copy_jobs, clone_engine)
+
 
 if __name__ == "__main__":  # pragma: no cover
     copy()
@@ -23,20 +23,49 @@
 
 import contextlib
 import csv
+import functools
 import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
+import select
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from fnmatch import fnmatch
 
 import click
 import dodoo
+import psycopg2
 from dodoo import odoo
 
+from utils import gitutils
 from utils.manifest import expand_dependencies
 
-from ._dbutils import pg_connect
+from . import _profiling
+from ._clone import AUTO, CLONE_ENGINES, clone_database, clone_databases
+from ._dbutils import database_size, pg_connect
+from ._eviction import EVICTION_POLICIES, LruPolicy, eviction_policy
+from ._filestore import (
+    drop_filestore,
+    filestore_path,
+    filestore_size,
+    link_filestore,
+    rename_filestore,
+)
+from ._hashing import (
+    HASH_ALGORITHMS,
+    FingerprintCache,
+    file_digest,
+    new_hash,
+    update_from_file,
+)
+from ._metrics import MISS_EVICTED, MISS_NEW_HASH, MISS_NEW_MODULE_SET, Metrics
+from ._modulelist import modules_fingerprint, sync_module_list
 
 _logger = logging.getLogger(__name__)
 
@@ -79,16 +108,22 @@ def _patch_ir_attachment_store(force_db_storage):
             IrAttachment._storage = orig
 
 
+def _odoo_load(dbname, demo):
+    odoo.tools.config["without_demo"] = not demo
+    if odoo.release.version_info[0] < 10:
+        Registry = odoo.modules.registry.RegistryManager
+    else:
+        Registry = odoo.modules.registry.Registry
+    with _profiling.span("registry load {}".format(dbname)):
+        Registry.new(dbname, force_demo=demo, update_module=True)
+
+
 def odoo_createdb(dbname, demo, module_names, force_db_storage):
     with _patch_ir_attachment_store(force_db_storage):
-        odoo.service.db._create_empty_database(dbname)
+        with _profiling.span("create empty database {}".format(dbname)):
+            odoo.service.db._create_empty_database(dbname)
         odoo.tools.config["init"] = dict.fromkeys(module_names, 1)
-        odoo.tools.config["without_demo"] = not demo
-        if odoo.release.version_info[0] < 10:
-            Registry = odoo.modules.registry.RegistryManager
-        else:
-            Registry = odoo.modules.registry.Registry
-        Registry.new(dbname, force_demo=demo, update_module=True)
+        _odoo_load(dbname, demo)
         _logger.info(
             click.style(
                 "Created new Odoo database {dbname}.".format(**locals()), fg="green"
@@ -97,6 +132,37 @@ def odoo_createdb(dbname, demo, module_names, force_db_storage):
         odoo.sql_db.close_db(dbname)
 
 
+def odoo_upgrade(dbname, demo, module_names, force_db_storage):
+    """ Upgrade modules in an existing database """
+    with _patch_ir_attachment_store(force_db_storage):
+        odoo.tools.config["update"] = dict.fromkeys(module_names, 1)
+        try:
+            _odoo_load(dbname, demo)
+        finally:
+            odoo.tools.config["update"] = {}
+        _logger.info(
+            click.style(
+                "Upgraded {} modules in {}.".format(len(module_names), dbname),
+                fg="green",
+            )
+        )
+        odoo.sql_db.close_db(dbname)
+
+
+def odoo_install(dbname, demo, module_names, force_db_storage):
+    """ Install modules in an existing database """
+    with _patch_ir_attachment_store(force_db_storage):
+        odoo.tools.config["init"] = dict.fromkeys(module_names, 1)
+        _odoo_load(dbname, demo)
+        _logger.info(
+            click.style(
+                "Installed {} modules in {}.".format(len(module_names), dbname),
+                fg="green",
+            )
+        )
+        odoo.sql_db.close_db(dbname)
+
+
 def _fnmatch(filename, patterns):
     for pattern in patterns:
         if fnmatch(filename, pattern):
@@ -117,44 +183,240 @@ def _walk(top, exclude_patterns=EXCLUDE_PATTERNS):
             yield filepath
 
 
-def addons_hash(module_names, with_demo):
-    h = hashlib.sha1()
+def _module_digest(module_path, algorithm, fingerprints):
+    h = new_hash(algorithm)
+    for filepath in _walk(module_path):
+        h.update(filepath.encode("utf8"))
+        fullpath = os.path.join(module_path, filepath)
+        if fingerprints is not None:
+            digest = fingerprints.digest(fullpath, algorithm)
+        else:
+            digest = file_digest(fullpath, algorithm)
+        h.update(digest.encode("utf8"))
+    return h.hexdigest()
+
+
+def _git_digests(module_paths):
+    """ Return a {module_path: digest} dict of modules that are committed
+    in a git work tree without local changes, based on their tree id.
+
+    Ignored files are local changes too, as they are hashed with the
+    other files of modules, unless excluded from hashing.
+    """
+    repos = {}
+    toplevels = {}
+    for module_path in module_paths:
+        realpath = os.path.realpath(module_path)
+        parent = os.path.dirname(realpath)
+        if parent not in toplevels:
+            toplevels[parent] = gitutils.get_toplevel(parent)
+        toplevel = toplevels[parent]
+        if toplevel:
+            relpath = os.path.relpath(realpath, toplevel)
+            repos.setdefault(toplevel, {})[relpath] = module_path
+    res = {}
+    for toplevel, modules in repos.items():
+        relpaths = sorted(modules)
+        try:
+            tree_ids = gitutils.tree_ids(relpaths, cwd=toplevel)
+            dirty_paths = gitutils.dirty_paths(relpaths, cwd=toplevel, ignored=True)
+        except subprocess.CalledProcessError:
+            _logger.warning("Could not get git status of %s", toplevel)
+            continue
+        dirty_dirs = set()
+        for dirty_path in dirty_paths:
+            if _fnmatch(dirty_path, EXCLUDE_PATTERNS):
+                continue
+            while dirty_path:
+                dirty_path = os.path.dirname(dirty_path)
+                dirty_dirs.add(dirty_path)
+        for relpath, tree_id in tree_ids.items():
+            if relpath not in dirty_dirs:
+                res[modules[relpath]] = "git:" + tree_id
+    return res
+
+
+def module_digests(
+    module_names, algorithm="sha1", jobs=1, fingerprints=None, git=False
+):
+    """ Return a {module_name: digest} dict of modules and their
+    dependencies, hashing modules concurrently on jobs threads.
+
+    With git, modules committed in a git work tree without local
+    changes are identified by their tree id instead of being read.
+    """
+    module_names = sorted(expand_dependencies(module_names, True, True))
+    module_paths = [odoo.modules.get_module_path(m) for m in module_names]
+    git_digests = _git_digests(module_paths) if git else {}
+
+    def _digest(module_path):
+        if module_path in git_digests:
+            return git_digests[module_path]
+        return _module_digest(module_path, algorithm, fingerprints)
+
+    _logger.debug(
+        "%s of %s modules fingerprinted from git.",
+        len(git_digests),
+        len(module_paths),
+    )
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return dict(zip(module_names, executor.map(_digest, module_paths)))
+
+
+def combine_digests(digests, with_demo, algorithm="sha1"):
+    h = new_hash(algorithm)
     h.update("!demo={}!".format(int(bool(with_demo))).encode("utf8"))
-    for module_name in sorted(expand_dependencies(module_names, True, True)):
-        module_path = odoo.modules.get_module_path(module_name)
+    for module_name in sorted(digests):
         h.update(module_name.encode("utf8"))
-        for filepath in _walk(module_path):
-            h.update(filepath.encode("utf8"))
-            with open(os.path.join(module_path, filepath), "rb") as f:
-                h.update(f.read())
+        h.update(digests[module_name].encode("utf8"))
     return h.hexdigest()
 
 
+def addons_hash(
+    module_names, with_demo, fingerprints=None, algorithm=None, jobs=1, git=False
+):
+    """ Compute a checksum of modules and their dependencies.
+
+    Without fingerprints, algorithm nor git, this is a sha1 of the
+    content of all module files, compatible with existing cache templates.
+
+    Otherwise per-module digests are computed concurrently, reusing
+    per-file digests from the FingerprintCache if one is provided,
+    or git tree ids if git is set, and combined in module name order.
+    This yields a different checksum than hashing the file contents
+    directly.
+    """
+    return _hash_addons(module_names, with_demo, fingerprints, algorithm, jobs, git)[0]
+
+
+@contextlib.contextmanager
+def _fingerprint_cache(path):
+    if not path:
+        yield None
+        return
+    with FingerprintCache(path) as fingerprints:
+        yield fingerprints
+    _logger.info(
+        "Fingerprint cache: {} hits, {} misses.".format(
+            fingerprints.hits, fingerprints.misses
+        )
+    )
+
+
+def _hash_addons(module_names, demo, fingerprints, algorithm, jobs, git):
+    """ Return (hashsum, digests), the hashsum being addons_hash().
+
+    digests are the per-module digests the hashsum was combined from,
+    or None for legacy checksums.
+    """
+    if fingerprints is None and algorithm is None and not git:
+        h = hashlib.sha1()
+        h.update("!demo={}!".format(int(bool(demo))).encode("utf8"))
+        for module_name in sorted(expand_dependencies(module_names, True, True)):
+            module_path = odoo.modules.get_module_path(module_name)
+            h.update(module_name.encode("utf8"))
+            for filepath in _walk(module_path):
+                h.update(filepath.encode("utf8"))
+                update_from_file(h, os.path.join(module_path, filepath))
+        return h.hexdigest(), None
+    algorithm = algorithm or "sha1"
+    digests = module_digests(module_names, algorithm, jobs, fingerprints, git)
+    return combine_digests(digests, demo, algorithm), digests
+
+
 def refresh_module_list(dbname):
     self = click.get_current_context().command
     self.database = dbname
-    with dodoo.OdooEnvironment(self) as env:
-        env["ir.module.module"].update_list()
+    with _profiling.span("refresh module list") as span:
+        with dodoo.OdooEnvironment(self) as env:
+            # number of updated and added modules
+            span.add(rows=sum(env["ir.module.module"].update_list()))
+
+
+def update_module_list(dbname):
+    """ Update the module list of dbname from the addons path with SQL,
+    without loading the registry. Fall back to refresh_module_list
+    if this fails. """
+    try:
+        with _profiling.span("sync module list") as span:
+            db = odoo.sql_db.db_connect(dbname)
+            try:
+                with db.cursor() as cr:
+                    updated, added = sync_module_list(cr)
+            finally:
+                odoo.sql_db.close_db(dbname)
+            span.add(rows=updated + added)
+    except Exception:
+        _logger.warning(
+            "Could not update module list of %s, refreshing it", dbname, exc_info=True
+        )
+        refresh_module_list(dbname)
+        return
+    _logger.info(
+        "Updated module list: {} modules updated, {} added.".format(updated, added)
+    )
+
+
+def _make_lock_id(prefix, *parts):
+    # try to make a unique lock id based on the cache prefix
+    h = hashlib.sha1()
+    h.update(prefix.encode("utf8"))
+    for part in parts:
+        h.update("-{}".format(part).encode("utf8"))
+    return int(h.hexdigest()[:14], 16)
 
 
 class DbCache:
     """ Manage a cache of db templates.
 
     Templates are named prefix-YYYYmmddHHMM-hashsum, where
-    YYYYmmddHHMM is the date and time when the given hashsum has last been
-    used for that prefix.
+    YYYYmmddHHMM is the date and time when the template was created.
+    They are recorded in a catalog table of the maintenance database,
+    together with their modules, build duration, size and usage, which
+    is used to look them up and to evict them. Templates named like this
+    but not in the catalog, created by previous versions, are added to
+    the catalog using the date in their name as last use date.
+
+    Spare databases, already cloned from a template and named
+    prefix-spare-hashsum-NN, are renamed instead of cloning the
+    template when available.
+
+    Templates keep a copy of the filestore of the database they are
+    created from, which is hardlinked into the filestore of the databases
+    created from them. It is dropped with the template. The host holding
+    it is recorded, and templates whose filestore is not available on
+    this host are ignored.
+
+    Operations on templates matching a given hashsum are serialized
+    by a lock specific to that hashsum, while trimming operations are
+    serialized by a lock specific to the prefix.
+
+    Evicted templates are remembered for a while, to tell why the
+    cache was missed.
     """
 
+    CATALOG = "dodoo_template_cache"
+    EVICTED = "dodoo_template_cache_evicted"
+    EVICTED_RETENTION = timedelta(days=90)
+    MAX_SPARES = 100
+    # how often processes waiting for a template being built by
+    # another process check that this other process is still alive
+    BUILD_CHECK_INTERVAL = 30
+
     HASH_SIZE = hashlib.sha1().digest_size * 2
-    MAX_HASHSUM = "f" * HASH_SIZE
 
-    def __init__(self, prefix):
+    def __init__(self, prefix, metrics=None, clone_engine=AUTO):
         check_cache_prefix(prefix)
         self.prefix = prefix
+        self.metrics = metrics or Metrics(prefix)
+        self.clone_engine = clone_engine
         self.lock_id = self._make_lock_id()
+        # not specific to the prefix, as the catalog is shared
+        self.catalog_lock_id = _make_lock_id(self.CATALOG)
         conn = odoo.sql_db.db_connect("postgres")
         self.pgcr = conn.cursor()
         self.pgcr.autocommit(True)
+        self._init_catalog()
 
     def __enter__(self):
         return self
@@ -165,19 +427,218 @@ class DbCache:
     def close(self):
         self.pgcr.close()
 
-    def _make_lock_id(self):
-        # try to make a unique lock id based on the cache prefix
-        h = hashlib.sha1()
-        h.update(self.prefix.encode("utf8"))
-        return int(h.hexdigest()[:14], 16)
+    def _make_lock_id(self, *parts):
+        return _make_lock_id(self.prefix, *parts)
+
+    @contextlib.contextmanager
+    def _lock(self, hashsum=None):
+        """ Lock the templates matching hashsum, or the whole prefix """
+        lock_id = self._make_lock_id(hashsum) if hashsum else self.lock_id
+        with _profiling.lock_wait("lock {}".format(hashsum or self.prefix)):
+            self.pgcr.execute("SELECT pg_advisory_lock(%s::bigint)", (lock_id,))
+        try:
+            yield
+        finally:
+            self.pgcr.execute("SELECT pg_advisory_unlock(%s::bigint)", (lock_id,))
+
+    def _try_lock(self, lock_id):
+        self.pgcr.execute("SELECT pg_try_advisory_lock(%s::bigint)", (lock_id,))
+        return self.pgcr.fetchone()[0]
+
+    def _unlock(self, lock_id):
+        self.pgcr.execute("SELECT pg_advisory_unlock(%s::bigint)", (lock_id,))
+
+    def _wait_notify(self, timeout):
+        """ Wait for a notification on channels listened to, at most
+        timeout seconds. Return True if one was received. """
+        conn = self.pgcr._cnx
+        deadline = time.time() + timeout
+        while True:
+            conn.poll()
+            if conn.notifies:
+                del conn.notifies[:]
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            select.select([conn], [], [], remaining)
 
     @contextlib.contextmanager
-    def _lock(self):
-        self.pgcr.execute("SELECT pg_advisory_lock(%s::bigint)", (self.lock_id,))
+    def build_lock(self, hashsum, timeout):
+        """ Let a single process at a time build the template matching
+        hashsum.
+
+        Processes entering this context while another one is in it wait
+        until it exits, woken by a notification, then enter it in turn.
+        They must look the template up again before building it, as it
+        was most likely built meanwhile, unless the build failed. A
+        ClickException is raised after waiting timeout seconds.
+        """
+        lock_id = self._make_lock_id("build", hashsum)
+        channel = "dodoo_build_{}".format(lock_id)
+        self.pgcr.execute("LISTEN {}".format(channel))
+        try:
+            with _profiling.lock_wait("build lock {}".format(hashsum)):
+                self._wait_build_lock(lock_id, hashsum, timeout)
+            try:
+                yield
+            finally:
+                self._unlock(lock_id)
+                self.pgcr.execute("NOTIFY {}".format(channel))
+        finally:
+            self.pgcr.execute("UNLISTEN {}".format(channel))
+
+    def _wait_build_lock(self, lock_id, hashsum, timeout):
+        """ Acquire the build lock, trying again on each notification
+        that a build is done, at most timeout seconds """
+        deadline = time.time() + timeout
+        while not self._try_lock(lock_id):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise click.ClickException(
+                    "Timeout waiting for template {} to be built "
+                    "by another process".format(hashsum)
+                )
+            _logger.info(
+                "Waiting for template {} to be built "
+                "by another process".format(hashsum)
+            )
+            self._wait_notify(min(remaining, self.BUILD_CHECK_INTERVAL))
+
+    @contextlib.contextmanager
+    def _catalog_lock(self):
+        with _profiling.lock_wait("catalog lock"):
+            self.pgcr.execute(
+                "SELECT pg_advisory_lock(%s::bigint)", (self.catalog_lock_id,)
+            )
         try:
             yield
         finally:
-            self.pgcr.execute("SELECT pg_advisory_unlock(%s::bigint)", (self.lock_id,))
+            self._unlock(self.catalog_lock_id)
+
+    def _init_catalog(self):
+        """ Create the catalog if needed, and synchronize it with the
+        databases of this prefix """
+        with self._catalog_lock():
+            self.pgcr.execute(
+                """
+                CREATE TABLE IF NOT EXISTS {} (
+                    datname VARCHAR PRIMARY KEY,
+                    prefix VARCHAR NOT NULL,
+                    hashsum VARCHAR NOT NULL,
+                    demo BOOLEAN,
+                    modules TEXT,
+                    build_duration DOUBLE PRECISION,
+                    size BIGINT,
+                    create_date TIMESTAMP NOT NULL,
+                    last_used TIMESTAMP NOT NULL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    modules_fingerprint VARCHAR,
+                    filestore_size BIGINT,
+                    filestore_host VARCHAR
+                )
+            """.format(
+                    self.CATALOG
+                )
+            )
+            self.pgcr.execute(
+                """
+                CREATE TABLE IF NOT EXISTS {} (
+                    prefix VARCHAR NOT NULL,
+                    hashsum VARCHAR NOT NULL,
+                    evict_date TIMESTAMP NOT NULL
+                )
+            """.format(
+                    self.EVICTED
+                )
+            )
+            self.pgcr.execute(
+                "DELETE FROM {} WHERE evict_date < %s".format(self.EVICTED),
+                (datetime.utcnow() - self.EVICTED_RETENTION,),
+            )
+            # forget templates dropped by other means
+            self.pgcr.execute(
+                """
+                DELETE FROM {} WHERE prefix = %s AND datname NOT IN (
+                    SELECT datname FROM pg_database
+                )
+            """.format(
+                    self.CATALOG
+                ),
+                (self.prefix,),
+            )
+            self._migrate_templates()
+
+    def _migrate_templates(self):
+        """ Add templates encoding their last use date in their name,
+        and their modules in their comment, to the catalog """
+        self.pgcr.execute(
+            """
+            SELECT datname, shobj_description(oid, 'pg_database'),
+                   pg_database_size(datname)
+            FROM pg_database
+            WHERE datname like %s AND datname NOT IN (
+                SELECT datname FROM {}
+            )
+        """.format(
+                self.CATALOG
+            ),
+            (self._make_pattern(),),
+        )
+        for datname, description, size in self.pgcr.fetchall():
+            try:
+                dt = datetime.strptime(datname.split("-")[-2], "%Y%m%d%H%M")
+            except ValueError:
+                continue
+            try:
+                metadata = json.loads(description or "")
+            except ValueError:
+                metadata = {}  # template created before metadata were recorded
+            _logger.info("Adding template {} to catalog".format(datname))
+            self._insert_catalog(
+                datname,
+                self._hashsum(datname),
+                metadata.get("modules"),
+                metadata.get("demo"),
+                None,
+                size,
+                dt,
+            )
+
+    def _insert_catalog(
+        self,
+        datname,
+        hashsum,
+        digests,
+        demo,
+        duration,
+        size,
+        dt,
+        modules_fingerprint=None,
+    ):
+        self.pgcr.execute(
+            """
+            INSERT INTO {} (
+                datname, prefix, hashsum, demo, modules,
+                build_duration, size, create_date, last_used,
+                modules_fingerprint
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """.format(
+                self.CATALOG
+            ),
+            (
+                datname,
+                self.prefix,
+                hashsum,
+                demo,
+                json.dumps(digests, sort_keys=True) if digests is not None else None,
+                duration,
+                size,
+                dt,
+                dt,
+                modules_fingerprint,
+            ),
+        )
 
     def _make_pattern(self, dt=None, hs=None):
         if dt:
@@ -203,17 +664,10 @@ class DbCache:
                 fg="green",
             )
         )
-        self.pgcr.execute(
-            """
-            CREATE DATABASE "{dbname}"
-            ENCODING 'unicode'
-            TEMPLATE "{template}"
-        """.format(
-                **locals()
-            )
-        )
+        clone_database(self.pgcr, template, dbname, self.clone_engine, "unicode")
+        link_filestore(template, dbname)
 
-    def _rename_db(self, dbname_from, dbname_to):
+    def _alter_db_name(self, dbname_from, dbname_to):
         self.pgcr.execute(
             """
             ALTER DATABASE "{dbname_from}"
@@ -223,119 +677,641 @@ class DbCache:
             )
         )
 
+    def _rename_db(self, dbname_from, dbname_to):
+        with _profiling.span("rename database {}".format(dbname_from)):
+            self._alter_db_name(dbname_from, dbname_to)
+        try:
+            rename_filestore(dbname_from, dbname_to)
+        except OSError:
+            # keep the database with its filestore
+            self._alter_db_name(dbname_to, dbname_from)
+            raise
+
     def _drop_db(self, dbname):
         _logger.info("Dropping database {dbname}".format(**locals()))
+        with _profiling.span("drop database {}".format(dbname)):
+            self.pgcr.execute(
+                """
+                DROP DATABASE "{dbname}"
+            """.format(
+                    **locals()
+                )
+            )
+        drop_filestore(dbname)
+
+    def _hashsum(self, template_name):
+        # strip prefix-YYYYmmddHHMM-
+        return template_name[len(self.prefix) + 14 :]
+
+    def _filestore_available(self, template_name, filestore_host):
+        """ Tell whether the filestore of template_name, if it has one,
+        is available on this host """
+        if filestore_host is None:
+            return True
+        return filestore_host == socket.gethostname() and os.path.isdir(
+            filestore_path(template_name)
+        )
+
+    def _find_templates_modules(self, demo):
+        """ yield (template_name, {module_name: digest}) of templates
+        with the same prefix and demo, MRU first """
         self.pgcr.execute(
             """
-            DROP DATABASE "{dbname}"
+            SELECT datname, modules, filestore_host FROM {}
+            WHERE prefix = %s AND demo = %s AND modules IS NOT NULL
+            ORDER BY last_used DESC  -- MRU first
         """.format(
-                **locals()
-            )
+                self.CATALOG
+            ),
+            (self.prefix, bool(demo)),
         )
+        for datname, modules, filestore_host in self.pgcr.fetchall():
+            if self._filestore_available(datname, filestore_host):
+                yield datname, json.loads(modules)
+
+    def _find_nearest_template(self, digests, demo):
+        """ search same prefix and demo, with the largest set of
+        modules that is a subset of digests with the same digests """
+        best = None
+        for datname, modules in self._find_templates_modules(demo):
+            if any(digests.get(m) != d for m, d in modules.items()):
+                continue
+            if best is None or len(modules) > len(best[1]):
+                best = (datname, set(modules))
+        return best
+
+    def _find_stale_template(self, digests, demo):
+        """ search same prefix, demo and set of modules, MRU first,
+        and return it with the set of modules having other digests """
+        for datname, modules in self._find_templates_modules(demo):
+            if set(modules) != set(digests):
+                continue
+            return datname, {m for m, d in modules.items() if digests[m] != d}
+        return None
 
     def _find_template(self, hashsum):
-        """ search same prefix and hashsum, any date """
-        pattern = self.prefix + "-____________-" + hashsum
+        """ search same prefix and hashsum """
+        self.pgcr.execute(
+            """
+            SELECT datname, filestore_host FROM {}
+            WHERE prefix = %s AND hashsum = %s
+            ORDER BY last_used DESC  -- MRU first
+        """.format(
+                self.CATALOG
+            ),
+            (self.prefix, hashsum),
+        )
+        for datname, filestore_host in self.pgcr.fetchall():
+            if self._filestore_available(datname, filestore_host):
+                return datname
+        return None
+
+    def _make_spare_pattern(self, hashsum=None, prefix=None):
+        return "{}-spare-{}-%".format(prefix or self.prefix, hashsum or "%")
+
+    def _make_spare_name(self, hashsum, index):
+        return "{}-spare-{}-{:02d}".format(self.prefix, hashsum, index)
+
+    def _find_spares(self, hashsum=None, prefix=None):
         self.pgcr.execute(
             """
             SELECT datname FROM pg_database
             WHERE datname like %s
-            ORDER BY datname DESC  -- MRU first
+            ORDER BY datname
         """,
-            (pattern,),
+            (self._make_spare_pattern(hashsum, prefix),),
         )
-        r = self.pgcr.fetchone()
-        if r:
-            return r[0]
-        else:
-            return None
+        return [datname for (datname,) in self.pgcr.fetchall()]
+
+    def _claim_spare(self, new_database, hashsum):
+        for spare_name in self._find_spares(hashsum):
+            try:
+                self._rename_db(spare_name, new_database)
+            except (psycopg2.Error, OSError):
+                _logger.warning("Could not claim spare database %s", spare_name)
+                continue
+            _logger.info(
+                click.style(
+                    "Claimed spare database {spare_name}".format(**locals()),
+                    fg="green",
+                )
+            )
+            return True
+        return False
 
-    def _touch(self, template_name, hashsum):
-        # change the template date (MRU mechanism)
-        assert template_name.endswith(hashsum)
-        new_template_name = self._make_new_template_name(hashsum)
-        if template_name != new_template_name:
-            self._rename_db(template_name, new_template_name)
+    def _drop_template(self, template_name, last_used=None, prefix=None):
+        """ Drop template_name and its spares, unless the template is
+        in use or has been used since last_used. Return True if dropped.
+
+        prefix allows dropping templates of other prefixes.
+        """
+        prefix = prefix or self.prefix
+        hashsum = template_name[len(prefix) + 14 :]
+        lock_id = _make_lock_id(prefix, hashsum)
+        if not self._try_lock(lock_id):
+            return False
+        try:
+            self.pgcr.execute(
+                "SELECT last_used FROM {} WHERE datname = %s".format(self.CATALOG),
+                (template_name,),
+            )
+            r = self.pgcr.fetchone()
+            if not r or (last_used and r[0] != last_used):
+                return False
+            self._drop_db(template_name)
+            self.pgcr.execute(
+                "DELETE FROM {} WHERE datname = %s".format(self.CATALOG),
+                (template_name,),
+            )
+            self.pgcr.execute(
+                "INSERT INTO {} VALUES (%s, %s, %s)".format(self.EVICTED),
+                (prefix, hashsum, datetime.utcnow()),
+            )
+            for spare_name in self._find_spares(hashsum, prefix):
+                self._drop_db(spare_name)
+            return True
+        finally:
+            self._unlock(lock_id)
+
+    def _touch(self, template_name):
+        # record the template usage (MRU mechanism)
+        self.pgcr.execute(
+            """
+            UPDATE {}
+            SET last_used = %s, hit_count = hit_count + 1
+            WHERE datname = %s
+        """.format(
+                self.CATALOG
+            ),
+            (datetime.utcnow(), template_name),
+        )
+
+    def _record_template_metrics(self, template_name):
+        self.pgcr.execute(
+            "SELECT size, build_duration FROM {} WHERE datname = %s".format(
+                self.CATALOG
+            ),
+            (template_name,),
+        )
+        size, build_duration = self.pgcr.fetchone()
+        self.metrics.set(template_size=size, template_build_duration=build_duration)
 
     def create(self, new_database, hashsum):
         """ Create a new database from a cached template matching hashsum """
-        with self._lock():
-            template_name = self._find_template(hashsum)
+        with self._lock(hashsum):
+            with self.metrics.timer("lookup"):
+                template_name = self._find_template(hashsum)
             if not template_name:
                 return False
             else:
-                self._create_db_from_template(new_database, template_name)
-                self._touch(template_name, hashsum)
+                with self.metrics.timer("clone"):
+                    if not self._claim_spare(new_database, hashsum):
+                        self._create_db_from_template(new_database, template_name)
+                self._touch(template_name)
+                self._record_template_metrics(template_name)
                 return True
 
-    def add(self, new_database, hashsum):
-        """ Create a new cached template """
-        with self._lock():
+    def modules_fingerprint(self, hashsum):
+        """ Return the modules fingerprint recorded with the template
+        matching hashsum, if any """
+        self.pgcr.execute(
+            """
+            SELECT modules_fingerprint FROM {}
+            WHERE prefix = %s AND hashsum = %s
+            ORDER BY last_used DESC
+        """.format(
+                self.CATALOG
+            ),
+            (self.prefix, hashsum),
+        )
+        r = self.pgcr.fetchone()
+        return r[0] if r else None
+
+    def miss_reason(self, hashsum, module_names, demo):
+        """ Tell why no template matches hashsum: it was evicted,
+        templates with the same modules have other digests (new hash),
+        or no template has the same modules (new module set).
+
+        module_names are the modules to install with their dependencies.
+        """
+        self.pgcr.execute(
+            "SELECT 1 FROM {} WHERE prefix = %s AND hashsum = %s".format(
+                self.EVICTED
+            ),
+            (self.prefix, hashsum),
+        )
+        if self.pgcr.fetchone():
+            return MISS_EVICTED
+        for _, modules in self._find_templates_modules(demo):
+            if set(modules) == set(module_names):
+                return MISS_NEW_HASH
+        return MISS_NEW_MODULE_SET
+
+    def refill_spares(self, hashsum, count):
+        """ Clone the template matching hashsum until it has count spares.
+
+        The lock is released between clones, so other processes can use
+        the cache meanwhile. Return the number of spares created.
+        """
+        count = min(count, self.MAX_SPARES)
+        created = 0
+        while True:
+            with self._lock(hashsum):
+                template_name = self._find_template(hashsum)
+                spares = self._find_spares(hashsum)
+                if not template_name or len(spares) >= count:
+                    return created
+                for index in range(self.MAX_SPARES):
+                    spare_name = self._make_spare_name(hashsum, index)
+                    if spare_name not in spares:
+                        break
+                self._create_db_from_template(spare_name, template_name)
+            created += 1
+
+    def refill_all_spares(self, count):
+        """ Refill the spares of all cached templates, MRU first """
+        self.pgcr.execute(
+            """
+            SELECT hashsum FROM {}
+            WHERE prefix = %s
+            ORDER BY last_used DESC
+        """.format(
+                self.CATALOG
+            ),
+            (self.prefix,),
+        )
+        for (hashsum,) in self.pgcr.fetchall():
+            self.refill_spares(hashsum, count)
+
+    def create_nearest(self, new_database, digests, demo):
+        """ Create a new database from the cached template having the
+        largest subset of modules with unchanged digests.
+
+        Return the set of modules installed in the new database,
+        or None if no template matches.
+        """
+        nearest = self._find_nearest_template(digests, demo)
+        if not nearest:
+            return None
+        template_name, module_names = nearest
+        if not self._create_from(new_database, template_name):
+            # evicted meanwhile, try again
+            return self.create_nearest(new_database, digests, demo)
+        return module_names
+
+    def create_stale(self, new_database, digests, demo):
+        """ Create a new database from the most recently used cached
+        template having the same modules installed, with other digests.
+
+        Return the set of modules whose digest changed,
+        or None if no template matches.
+        """
+        stale = self._find_stale_template(digests, demo)
+        if not stale:
+            return None
+        template_name, module_names = stale
+        if not self._create_from(new_database, template_name):
+            # evicted meanwhile, try again
+            return self.create_stale(new_database, digests, demo)
+        return module_names
+
+    def _create_from(self, new_database, template_name):
+        """ Create a new database from template_name, unless it has been
+        evicted meanwhile. Return True if the database was created. """
+        hashsum = self._hashsum(template_name)
+        with self._lock(hashsum):
+            if self._find_template(hashsum) != template_name:
+                return False
+            self._create_db_from_template(new_database, template_name)
+            self._touch(template_name)
+            return True
+
+    def add(
+        self,
+        new_database,
+        hashsum,
+        digests=None,
+        demo=None,
+        build_duration=None,
+        modules_fingerprint=None,
+    ):
+        """ Create a new cached template
+
+        digests and demo are recorded with the template, so it can
+        later be found by create_nearest. modules_fingerprint identifies
+        the module list of the template, see modules_fingerprint().
+        """
+        with self._lock(hashsum):
             template_name = self._find_template(hashsum)
-            if template_name:
-                self._touch(template_name, hashsum)
-            else:
+            if not template_name:
                 new_template_name = self._make_new_template_name(hashsum)
                 self._create_db_from_template(new_template_name, new_database)
+                size = database_size(self.pgcr, new_template_name)
+                self._insert_catalog(
+                    new_template_name,
+                    hashsum,
+                    digests,
+                    demo,
+                    build_duration,
+                    size,
+                    datetime.utcnow(),
+                    modules_fingerprint,
+                )
+                if os.path.isdir(filestore_path(new_template_name)):
+                    filestore_host = socket.gethostname()
+                else:
+                    filestore_host = None
+                self.pgcr.execute(
+                    """
+                    UPDATE {}
+                    SET filestore_size = %s, filestore_host = %s
+                    WHERE datname = %s
+                """.format(
+                        self.CATALOG
+                    ),
+                    (
+                        filestore_size(new_template_name),
+                        filestore_host,
+                        new_template_name,
+                    ),
+                )
 
     @property
     def size(self):
+        self.pgcr.execute(
+            "SELECT count(*) FROM {} WHERE prefix = %s".format(self.CATALOG),
+            (self.prefix,),
+        )
+        return self.pgcr.fetchone()[0]
+
+    def purge(self):
         with self._lock():
-            pattern = self._make_pattern()
             self.pgcr.execute(
-                """
-                SELECT count(*) FROM pg_database
-                WHERE datname like %s
-            """,
-                (pattern,),
+                "SELECT datname FROM {} WHERE prefix = %s".format(self.CATALOG),
+                (self.prefix,),
+            )
+            for (datname,) in self.pgcr.fetchall():
+                with self._lock(self._hashsum(datname)):
+                    self._drop_db(datname)
+                    self.pgcr.execute(
+                        "DELETE FROM {} WHERE datname = %s".format(self.CATALOG),
+                        (datname,),
+                    )
+            for spare_name in self._find_spares():
+                self._drop_db(spare_name)
+            self.pgcr.execute(
+                "DELETE FROM {} WHERE prefix = %s".format(self.EVICTED),
+                (self.prefix,),
             )
-            return self.pgcr.fetchone()[0]
 
-    def purge(self):
+    def trim_size(self, max_size, policy=None):
+        """ Keep the max_size templates most worth keeping according to
+        the eviction policy (LRU by default) """
+        policy = policy or LruPolicy()
         with self._lock():
-            pattern = self._make_pattern()
             self.pgcr.execute(
                 """
-                SELECT datname FROM pg_database
-                WHERE datname like %s
-            """,
-                (pattern,),
+                SELECT datname, last_used FROM {}
+                WHERE prefix = %(prefix)s
+                ORDER BY {}
+                OFFSET %(offset)s
+            """.format(
+                    self.CATALOG, policy.order_by()
+                ),
+                {"prefix": self.prefix, "offset": max_size, "now": datetime.utcnow()},
             )
-            for (datname,) in self.pgcr.fetchall():
-                self._drop_db(datname)
+            for datname, last_used in self.pgcr.fetchall():
+                self._drop_template(datname, last_used)
 
-    def trim_size(self, max_size):
+    def _spares_count(self):
+        """ Return a {(prefix, hashsum): number of spares} dict """
+        self.pgcr.execute(
+            "SELECT datname FROM pg_database WHERE datname like %s", ("%-spare-%-%",)
+        )
+        res = {}
+        for (datname,) in self.pgcr.fetchall():
+            base = datname.rsplit("-", 1)[0]
+            hashsum = base[-self.HASH_SIZE :]
+            prefix = base[: -self.HASH_SIZE - len("-spare-")]
+            res[(prefix, hashsum)] = res.get((prefix, hashsum), 0) + 1
+        return res
+
+    def trim_bytes(self, max_bytes, policy=None):
+        """ Keep the templates most worth keeping according to the
+        eviction policy (LRU by default), as long as the disk space they
+        use with their spares and filestore fits in max_bytes.
+
+        The budget is shared by the templates of all prefixes. The
+        templates to drop are chosen under the catalog lock, and dropped
+        after releasing it, each under the lock of its hashsum. Those used
+        meanwhile are kept, possibly exceeding max_bytes until next time.
+        """
+        policy = policy or LruPolicy()
         with self._lock():
-            pattern = self._make_pattern()
+            for datname, prefix, last_used in self._trim_bytes_victims(
+                max_bytes, policy
+            ):
+                self._drop_template(datname, last_used, prefix)
+
+    def _trim_bytes_victims(self, max_bytes, policy):
+        """ Return the (datname, prefix, last_used) of the templates
+        to drop so that the other ones fit in max_bytes """
+        victims = []
+        with self._catalog_lock():
             self.pgcr.execute(
                 """
-                SELECT datname FROM pg_database
-                WHERE datname like %s
-                ORDER BY datname DESC
-                OFFSET %s
-            """,
-                (pattern, max_size),
+                UPDATE {} SET size = pg_database_size(datname)
+                WHERE datname IN (SELECT datname FROM pg_database)
+            """.format(
+                    self.CATALOG
+                )
             )
-            for (datname,) in self.pgcr.fetchall():
-                self._drop_db(datname)
+            self.pgcr.execute(
+                """
+                SELECT datname, prefix, hashsum, size, filestore_size, last_used
+                FROM {}
+                ORDER BY {}
+            """.format(
+                    self.CATALOG, policy.order_by()
+                ),
+                {"now": datetime.utcnow()},
+            )
+            rows = self.pgcr.fetchall()
+            spares_count = self._spares_count()
+            total = 0
+            for datname, prefix, hashsum, size, fs_size, last_used in rows:
+                size = (size or 0) * (1 + spares_count.get((prefix, hashsum), 0))
+                # the filestores of spares are hardlinks to the template's
+                size += fs_size or 0
+                if total + size <= max_bytes:
+                    total += size
+                else:
+                    victims.append((datname, prefix, last_used))
+        return victims
 
     def trim_age(self, max_age):
         with self._lock():
-            pattern = self._make_pattern()
-            max_name = self._make_pattern(
-                dt=datetime.utcnow() - max_age, hs=self.MAX_HASHSUM
-            )
             self.pgcr.execute(
                 """
-                SELECT datname FROM pg_database
-                WHERE datname like %s
-                  AND datname <= %s
-                ORDER BY datname DESC
-            """,
-                (pattern, max_name),
+                SELECT datname, last_used FROM {}
+                WHERE prefix = %s
+                  AND last_used <= %s
+                ORDER BY last_used DESC
+            """.format(
+                    self.CATALOG
+                ),
+                (self.prefix, datetime.utcnow() - max_age),
             )
-            for (datname,) in self.pgcr.fetchall():
-                self._drop_db(datname)
+            for datname, last_used in self.pgcr.fetchall():
+                self._drop_template(datname, last_used)
+
+
+def _build_template(
+    dbcache,
+    new_database,
+    demo,
+    module_names,
+    hashsum,
+    digests,
+    reuse_nearest,
+    upgrade_stale,
+    fingerprint=None,
+    force_db_storage=True,
+):
+    start = time.time()
+    if upgrade_stale:
+        changed = dbcache.create_stale(new_database, digests, demo)
+        if changed is not None:
+            _logger.info(
+                click.style(
+                    "Found stale database template with {} changed modules.".format(
+                        len(changed)
+                    ),
+                    fg="green",
+                )
+            )
+            if changed:
+                odoo_upgrade(new_database, demo, sorted(changed), force_db_storage)
+            dbcache.add(
+                new_database, hashsum, digests, demo, time.time() - start, fingerprint
+            )
+            return
+    installed = None
+    if reuse_nearest:
+        installed = dbcache.create_nearest(new_database, digests, demo)
+    if installed is None:
+        odoo_createdb(new_database, demo, module_names, force_db_storage)
+    else:
+        missing = sorted(set(digests) - installed)
+        _logger.info(
+            click.style(
+                "Found nearest database template with {} of {} modules.".format(
+                    len(installed), len(digests)
+                ),
+                fg="green",
+            )
+        )
+        if missing:
+            odoo_install(new_database, demo, missing, force_db_storage)
+    dbcache.add(
+        new_database, hashsum, digests, demo, time.time() - start, fingerprint
+    )
+
+
+def _create_from_cache(
+    dbcache,
+    metrics,
+    new_database,
+    demo,
+    module_names,
+    hashsum,
+    digests,
+    compute_digests,
+    reuse_nearest,
+    upgrade_stale,
+    build_timeout,
+    cache_filestore,
+):
+    """ Create new_database from the template matching hashsum, or build
+    the template.
+
+    digests are None for legacy checksums. They are then only computed,
+    with compute_digests(), to reuse the nearest or stale templates, and
+    the templates built are not recorded with their modules.
+    """
+    hit = dbcache.create(new_database, hashsum)
+    if not hit:
+        with dbcache.build_lock(hashsum, build_timeout):
+            # another process may have built it meanwhile
+            hit = dbcache.create(new_database, hashsum)
+            if not hit:
+                if digests is None and (reuse_nearest or upgrade_stale):
+                    with metrics.timer("hash"):
+                        digests = compute_digests()
+                if digests is None:
+                    installed = expand_dependencies(module_names, True, True)
+                else:
+                    installed = set(digests)
+                metrics.set(miss_reason=dbcache.miss_reason(hashsum, installed, demo))
+                with metrics.timer("build"):
+                    _build_template(
+                        dbcache,
+                        new_database,
+                        demo,
+                        module_names,
+                        hashsum,
+                        digests,
+                        reuse_nearest,
+                        upgrade_stale,
+                        modules_fingerprint(),
+                        not cache_filestore,
+                    )
+    metrics.set(hit=hit)
+    if hit:
+        _logger.info(
+            click.style(
+                "Found matching database template! ✨ 🍰 ✨",
+                fg="green",
+                bold=True,
+            )
+        )
+        with metrics.timer("refresh"):
+            if modules_fingerprint() == dbcache.modules_fingerprint(hashsum):
+                _logger.info("Module list unchanged since the template was built.")
+            else:
+                update_module_list(new_database)
+        _record_time_saved(metrics)
+
+
+def _record_time_saved(metrics):
+    """ Estimate the time saved by a cache hit, as the build duration of
+    the template minus the time spent creating the database from it """
+    build_duration = metrics.values["template_build_duration"]
+    if build_duration is None:
+        return  # unknown for templates created by previous versions
+    spent = sum(metrics.timings.get(p, 0.0) for p in ("lookup", "clone", "refresh"))
+    metrics.set(time_saved=max(build_duration - spent, 0.0))
+
+
+def _expand_new_databases(new_databases, count):
+    if count is None:
+        res = list(new_databases)
+    elif (
+        len(new_databases) != 1
+        or new_databases[0].count("{}") != 1
+        or new_databases[0].count("{") != 1
+        or new_databases[0].count("}") != 1
+    ):
+        raise click.BadParameter(
+            "--count requires exactly one --new-database pattern containing "
+            "{} once, and no other braces",
+            param_hint="--new-database",
+        )
+    else:
+        res = [new_databases[0].format(i) for i in range(1, count + 1)]
+    if len(set(res)) != len(res):
+        raise click.ClickException("Duplicate new database names")
+    return res
 
 
 @click.command(cls=dodoo.CommandWithOdooEnv)
@@ -343,9 +1319,40 @@ class DbCache:
 @click.option(
     "--new-database",
     "-n",
+    "new_databases",
     required=False,
+    multiple=True,
     help="Name of new database to create, possibly from cache. "
-    "If absent, only the cache trimming operation is executed.",
+    "If absent, only the cache trimming operation is executed. "
+    "Can be repeated to create several identical databases: the "
+    "first one is created as usual, the other ones are cloned "
+    "from it.",
+)
+@click.option(
+    "--count",
+    type=int,
+    help="Create N identical databases, named by replacing {} in "
+    "the --new-database pattern by numbers from 1 to N.",
+)
+@click.option(
+    "--clone-jobs",
+    default=4,
+    show_default=True,
+    type=int,
+    help="Number of databases to clone concurrently when creating "
+    "several databases.",
+)
+@click.option(
+    "--clone-engine",
+    type=click.Choice(CLONE_ENGINES),
+    default=AUTO,
+    show_default=True,
+    help="How to copy databases from cache templates, or to create "
+    "several databases: with CREATE DATABASE TEMPLATE and the default "
+    "strategy of the server (template), the FILE_COPY or WAL_LOG "
+    "strategies of PostgreSQL >= 15, or pg_dump and pg_restore (dump). "
+    "By default, WAL_LOG is used for small databases and FILE_COPY "
+    "for the other ones when available.",
 )
 @click.option(
     "--modules",
@@ -367,7 +1374,8 @@ class DbCache:
     "such as max-age or size. Note: when the cache is "
     "enabled, all attachments created during database "
     "initialization are stored in database instead "
-    "of the default Odoo file store.",
+    "of the default Odoo file store, unless "
+    "--cache-filestore is set.",
 )
 @click.option(
     "--cache-prefix",
@@ -392,19 +1400,154 @@ class DbCache:
     default=5,
     show_default=True,
     type=int,
-    help="Keep N most recently used cache templates. Use "
-    "-1 to disable. Use 0 to empty cache.",
+    help="Keep N most recently used cache templates, or the ones "
+    "chosen by --cache-eviction. Use -1 to disable. Use 0 to empty cache.",
+)
+@click.option(
+    "--fingerprint-cache",
+    type=click.Path(dir_okay=False),
+    help="File in which to remember per-file digests of addons, "
+    "so files whose size, mtime and inode did not change are "
+    "not read again when computing the cache checksum. Note: "
+    "checksums computed this way differ from the ones computed "
+    "without this option.",
+)
+@click.option(
+    "--hash-algorithm",
+    type=click.Choice(HASH_ALGORITHMS),
+    help="Digest algorithm used to compute the cache checksum from "
+    "per-module digests. If absent, the checksum is a sha1 of the "
+    "content of all modules files, compatible with existing cache "
+    "templates, unless --fingerprint-cache is used.",
+)
+@click.option(
+    "--hash-jobs",
+    type=int,
+    help="Number of modules to hash concurrently, when computing "
+    "the cache checksum from per-module digests. Defaults to the "
+    "number of cores.",
+)
+@click.option(
+    "--git-fingerprints/--no-git-fingerprints",
+    default=False,
+    show_default=True,
+    help="Identify modules committed in a git work tree without "
+    "local changes by their git tree id instead of reading their "
+    "files, when computing the cache checksum. Other modules are "
+    "hashed file by file. Note: checksums computed this way "
+    "differ from the ones computed without this option.",
+)
+@click.option(
+    "--cache-reuse-nearest/--no-cache-reuse-nearest",
+    default=False,
+    show_default=True,
+    help="When no cache template matches, start from the cached "
+    "template having the largest subset of the modules to install, "
+    "with unchanged content, and install only the missing modules. "
+    "Note: the resulting database may differ from one where "
+    "the modules are installed from scratch.",
+)
+@click.option(
+    "--cache-upgrade-stale/--no-cache-upgrade-stale",
+    default=False,
+    show_default=True,
+    help="When no cache template matches, start from the most "
+    "recently used cached template having the same modules "
+    "installed and upgrade the modules whose content changed. "
+    "Note: the resulting database may differ from one where "
+    "the modules are installed from scratch.",
+)
+@click.option(
+    "--cache-spares",
+    default=0,
+    show_default=True,
+    type=int,
+    help="Keep N spare databases cloned from cache templates, which "
+    "are renamed instead of cloning the template on cache hits. "
+    "The spares of the template used are refilled after the new "
+    "database is created. Without --new-database, the spares of "
+    "all cache templates are refilled, so this can be run "
+    "separately to keep spares ready.",
+)
+@click.option(
+    "--cache-build-timeout",
+    default=3600,
+    show_default=True,
+    type=int,
+    help="When another process is already building the cache "
+    "template, wait at most N seconds for it to finish, and fail "
+    "otherwise.",
+)
+@click.option(
+    "--cache-eviction",
+    type=click.Choice(sorted(EVICTION_POLICIES)),
+    default=LruPolicy.name,
+    show_default=True,
+    help="Policy used to choose the cache templates to drop when "
+    "enforcing --cache-max-size and --cache-max-bytes: least recently "
+    "used, least frequently used, or cheapest to rebuild.",
+)
+@click.option(
+    "--cache-max-bytes",
+    default=-1,
+    show_default=True,
+    type=int,
+    help="Drop cache templates until the disk space used by the "
+    "templates of all prefixes, with their spares, fits in N bytes. "
+    "Use -1 to disable.",
+)
+@click.option(
+    "--cache-filestore/--no-cache-filestore",
+    default=False,
+    show_default=True,
+    help="Store the attachments created while building cache templates "
+    "in the filestore instead of the database. A copy of the filestore "
+    "is kept with each template and hardlinked into the filestore of the "
+    "databases created from it. This copy is local to the host: templates "
+    "having their filestore on another host are ignored, and are not "
+    "cleaned up from it when dropped, so hosts sharing a database server "
+    "should use distinct prefixes.",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(dir_okay=False),
+    help="Append the cache metrics of this run (hit or miss and its "
+    "reason, time spent in each phase, template size, estimated "
+    "time saved) as a JSON line to FILE.",
+)
+@click.option(
+    "--metrics-prom",
+    type=click.Path(dir_okay=False),
+    help="Write the cache metrics of this run to FILE in the format "
+    "of the Prometheus node exporter textfile collector.",
 )
 @click.argument("rawsql", required=False)
+@_profiling.profile_options
 def init(
     env,
-    new_database,
+    new_databases,
+    count,
+    clone_jobs,
+    clone_engine,
     modules,
     demo,
     cache,
     cache_prefix,
     cache_max_age,
     cache_max_size,
+    fingerprint_cache,
+    hash_algorithm,
+    hash_jobs,
+    git_fingerprints,
+    cache_reuse_nearest,
+    cache_upgrade_stale,
+    cache_spares,
+    cache_build_timeout,
+    cache_eviction,
+    cache_max_bytes,
+    cache_filestore,
+    metrics_file,
+    metrics_prom,
     rawsql,
 ):
     """ Create an Odoo database with pre-installed modules.
@@ -422,7 +1565,12 @@ def init(
     # See commit 68f14c68709bbb50cb7fb66d288955e1d769c5ff in odoo/odoo
     csv.field_size_limit(500 * 1024 * 1024)
 
+    hash_jobs = hash_jobs or multiprocessing.cpu_count()
+    new_databases = _expand_new_databases(new_databases, count)
+    new_database = new_databases[0] if new_databases else None
+    start = time.time()
     module_names = [m.strip() for m in modules.split(",")]
+    metrics = Metrics(cache_prefix if cache else None)
     if not cache:
         if new_database:
             odoo_createdb(new_database, demo, module_names, False)
@@ -431,31 +1579,76 @@ def init(
                 "Cache disabled and no new database name provided. " "Nothing to do."
             )
     else:
-        with DbCache(cache_prefix) as dbcache:
+        with DbCache(cache_prefix, metrics, clone_engine) as dbcache:
             if new_database:
-                hashsum = addons_hash(module_names, demo)
-                if dbcache.create(new_database, hashsum):
-                    _logger.info(
-                        click.style(
-                            "Found matching database template! ✨ 🍰 ✨",
-                            fg="green",
-                            bold=True,
+                with _fingerprint_cache(fingerprint_cache) as fingerprints:
+                    with metrics.timer("hash"):
+                        hashsum, digests = _hash_addons(
+                            module_names,
+                            demo,
+                            fingerprints,
+                            hash_algorithm,
+                            hash_jobs,
+                            git_fingerprints,
                         )
+                    _create_from_cache(
+                        dbcache,
+                        metrics,
+                        new_database,
+                        demo,
+                        module_names,
+                        hashsum,
+                        digests,
+                        functools.partial(
+                            module_digests,
+                            module_names,
+                            hash_algorithm or "sha1",
+                            hash_jobs,
+                            fingerprints,
+                            git_fingerprints,
+                        ),
+                        cache_reuse_nearest,
+                        cache_upgrade_stale,
+                        cache_build_timeout,
+                        cache_filestore,
                     )
-                    refresh_module_list(new_database)
-                else:
-                    odoo_createdb(new_database, demo, module_names, True)
-                    dbcache.add(new_database, hashsum)
-            if cache_max_size >= 0:
-                dbcache.trim_size(cache_max_size)
-            if cache_max_age >= 0:
-                dbcache.trim_age(timedelta(days=cache_max_age))
-
-    if rawsql:
-        with pg_connect(new_database) as cr:
+            policy = eviction_policy(cache_eviction)
+            with metrics.timer("trim"):
+                if cache_max_size >= 0:
+                    dbcache.trim_size(cache_max_size, policy)
+                if cache_max_age >= 0:
+                    dbcache.trim_age(timedelta(days=cache_max_age))
+                if cache_max_bytes >= 0:
+                    dbcache.trim_bytes(cache_max_bytes, policy)
+
+    if rawsql and new_database:
+        with pg_connect(new_database) as cr, _profiling.span("raw sql") as span:
             cr.execute(rawsql)
+            span.add(rows=max(cr.rowcount, 0))
             click.secho("RAW sql statment loaded! ✨ 🍰 ✨", fg="green", bold=True)
 
+    if new_database:
+        _logger.info(
+            "Database {} ready in {:.1f}s.".format(new_database, time.time() - start)
+        )
+        clone_databases(
+            new_database, new_databases[1:], clone_jobs, clone_engine, "unicode"
+        )
+
+    if cache and cache_spares > 0:
+        with DbCache(
+            cache_prefix, clone_engine=clone_engine
+        ) as dbcache, _profiling.span("refill spares"):
+            if new_database:
+                dbcache.refill_spares(hashsum, cache_spares)
+            else:
+                dbcache.refill_all_spares(cache_spares)
+
+    if metrics_file:
+        metrics.write_json(metrics_file)
+    if metrics_prom:
+        metrics.write_prometheus(metrics_prom)
+
 
 if __name__ == "__main__":  # pragma: no cover
     init()
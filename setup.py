@@ -24,7 +24,9 @@ setup(
         "pyyaml==3.12 ; python_version < '3.7'",
         "pyyaml==3.13 ; python_version >= '3.7'",
         "snapshotter",
+        "futures ; python_version < '3'",
     ],
+    extras_require={"zstd": ["zstandard>=0.15"], "lz4": ["lz4"]},
     license="LGPLv3+",
     author="XOE Labs",
     author_email="info@xoe.solutions",
@@ -45,5 +47,6 @@ setup(
         init=dodoo_dbhandler.initializer:init
         copy=dodoo_dbhandler.copier:copy
         snapshot=dodoo_dbhandler.backuper:snapshot
+        cachestats=dodoo_dbhandler.cachestats:cachestats
     """,
 )
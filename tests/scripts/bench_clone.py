@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Compare the database clone engines on a local cluster.
+
+Usage: bench_clone.py [size in MB] [repeat]
+
+A source database of about the given size is created, cloned with
+each available engine, and dropped afterwards. The postgres
+connection is configured with the usual PG* environment variables.
+"""
+import subprocess
+import sys
+import time
+
+import psycopg2
+from dodoo import odoo
+
+from dodoo_dbhandler._clone import AUTO, CLONE_ENGINES, clone_database, select_engine
+from dodoo_dbhandler._dbutils import database_size
+
+SOURCE = "dodoo-bench-clone-source"
+DEST = "dodoo-bench-clone-dest"
+
+
+def _dropdb(dbname):
+    subprocess.check_call(["dropdb", "--if-exists", dbname])
+
+
+def create_source(size_mb):
+    subprocess.check_call(["createdb", SOURCE])
+    conn = psycopg2.connect(dbname=SOURCE)
+    with conn, conn.cursor() as cr:
+        cr.execute("CREATE TABLE bench (id SERIAL PRIMARY KEY, data TEXT)")
+        # rows of about 1 kB
+        cr.execute(
+            "INSERT INTO bench (data) "
+            "SELECT repeat(md5(i::text), 32) FROM generate_series(1, %s) i",
+            (size_mb * 1024,),
+        )
+    conn.close()
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    # the dump engine runs pg_dump and pg_restore as configured for odoo
+    odoo.tools.config.parse_config([])
+    _dropdb(SOURCE)
+    create_source(size_mb)
+    conn = psycopg2.connect(dbname="postgres")
+    conn.autocommit = True
+    cr = conn.cursor()
+    try:
+        print(
+            "server {}, source {:.0f} MB, auto engine: {}".format(
+                conn.server_version,
+                database_size(cr, SOURCE) / 1024 / 1024,
+                select_engine(cr, SOURCE, AUTO),
+            )
+        )
+        for engine in CLONE_ENGINES:
+            if engine == AUTO:
+                continue
+            used = select_engine(cr, SOURCE, engine)
+            if used != engine:
+                print("{:<10} not available, {} would be used".format(engine, used))
+                continue
+            durations = []
+            for _i in range(repeat):
+                _dropdb(DEST)
+                # make the clones start from a clean state
+                try:
+                    cr.execute("CHECKPOINT")
+                except psycopg2.Error:
+                    pass  # not a superuser
+                start = time.time()
+                clone_database(cr, SOURCE, DEST, engine)
+                durations.append(time.time() - start)
+            print(
+                "{:<10} min {:.2f}s, max {:.2f}s".format(
+                    engine, min(durations), max(durations)
+                )
+            )
+    finally:
+        cr.close()
+        conn.close()
+        _dropdb(DEST)
+        _dropdb(SOURCE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+""" Compare the backup codecs on a synthetic filestore.
+
+Usage: bench_codecs.py [size in MB] [jobs]
+
+A filestore of about the given size is generated in a temporary
+directory, with half of compressible text documents and half of
+incompressible files starting like JPEG images, then archived with
+each available codec. Codecs whose package is missing are skipped.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from dodoo_dbhandler._backup import DEFLATE, LZ4, STORE, ZSTD, backup
+
+FILE_SIZE = 256 * 1024
+# (format, codec, level)
+CODECS = [
+    ("zip", STORE, None),
+    ("zip", DEFLATE, 1),
+    ("zip", DEFLATE, 6),
+    ("tar", STORE, None),
+    ("tar", LZ4, None),
+    ("tar", ZSTD, 1),
+    ("tar", ZSTD, 3),
+    ("tar", ZSTD, 9),
+]
+
+
+def create_filestore(path, size_mb):
+    words = [os.urandom(4).hex() for _i in range(2000)]
+    for i in range(size_mb * 1024 * 1024 // FILE_SIZE):
+        name = "{:040x}".format(i)
+        dirpath = os.path.join(path, name[:2])
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, name), "wb") as f:
+            if i % 2:
+                f.write(b"\xff\xd8\xff\xe0" + os.urandom(FILE_SIZE - 4))
+            else:
+                text = " ".join(words[(i + j) % len(words)] for j in range(FILE_SIZE))
+                f.write(text.encode("ascii")[:FILE_SIZE])
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    jobs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filestore = os.path.join(tmpdir, "filestore")
+        create_filestore(filestore, size_mb)
+        archive = os.path.join(tmpdir, "archive")
+        for format, codec, level in CODECS:
+            options = {"codec": codec, "level": level}
+            if format == "tar":
+                options["jobs"] = jobs
+            label = "{} {} {}".format(format, codec, "" if level is None else level)
+            start = time.time()
+            try:
+                with backup(format, archive, "w", **options) as b:
+                    b.addtree(filestore, "filestore")
+            except Exception as e:
+                print("{:<16} skipped: {}".format(label, e))
+                continue
+            duration = time.time() - start
+            size = os.path.getsize(archive)
+            print(
+                "{:<16} {:>8.1f} MB/s, {:>6.1f} MB ({:.0%})".format(
+                    label,
+                    size_mb / duration,
+                    size / 1024 / 1024,
+                    size / (size_mb * 1024 * 1024),
+                )
+            )
+            os.unlink(archive)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
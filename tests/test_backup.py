@@ -0,0 +1,143 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from dodoo_dbhandler import _backup
+from dodoo_dbhandler._backup import backup
+
+JPEG = b"\xff\xd8\xff\xe0" + os.urandom(1024)
+TEXT = b"Hello world\n" * 1024
+
+
+@pytest.fixture
+def tree(tmpdir):
+    src = tmpdir / "filestore"
+    src.mkdir()
+    src.join("image").write_binary(JPEG)
+    src.join("text").write_binary(TEXT)
+    return str(src)
+
+
+def test_is_compressed(tree):
+    assert _backup.is_compressed(os.path.join(tree, "image"))
+    assert not _backup.is_compressed(os.path.join(tree, "text"))
+
+
+@pytest.mark.parametrize("codec", ["deflate", "store"])
+def test_zip_codecs(tmpdir, tree, codec):
+    path = str(tmpdir / "backup.zip")
+    with backup("zip", path, "w", codec=codec, level=1) as b:
+        b.addtree(tree, "filestore")
+    with zipfile.ZipFile(path) as z:
+        compress_types = {i.filename: i.compress_type for i in z.infolist()}
+        assert z.read("filestore/image") == JPEG
+        assert z.read("filestore/text") == TEXT
+    # already compressed files are stored as is
+    assert compress_types["filestore/image"] == zipfile.ZIP_STORED
+    if codec == "store":
+        assert compress_types["filestore/text"] == zipfile.ZIP_STORED
+    else:
+        assert compress_types["filestore/text"] == zipfile.ZIP_DEFLATED
+
+
+def test_zip_unknown_codec(tmpdir):
+    with pytest.raises(Exception):
+        with backup("zip", str(tmpdir / "backup.zip"), "w", codec="zstd"):
+            pass
+
+
+@pytest.mark.parametrize("codec", ["store", "zstd", "lz4"])
+def test_tar_codecs(tmpdir, tree, codec, monkeypatch):
+    if codec == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+    elif codec == "lz4":
+        pytest.importorskip("lz4.frame")
+    monkeypatch.setattr(_backup.TarBackup, "CHUNK_SIZE", 1000)
+    path = str(tmpdir / "backup.tar")
+    with backup("tar", path, "w", codec=codec, jobs=2) as b:
+        b.addtree(tree, "filestore")
+        b.write(io.BytesIO(TEXT), "dump.sql")
+    with open(path, "rb") as f:
+        if codec == "zstd":
+            f = zstandard.ZstdDecompressor().stream_reader(f)
+        elif codec == "lz4":
+            f = _backup.lz4.frame.LZ4FrameFile(f)
+        with tarfile.open(fileobj=f, mode="r|") as tar:
+            members = {m.name: tar.extractfile(m).read() for m in tar if m.isfile()}
+    assert members["filestore/image"] == JPEG
+    parts = sorted(name for name in members if name.startswith("dump.sql.part"))
+    assert len(parts) == 13
+    assert b"".join(members[name] for name in parts) == TEXT
+
+
+class _Pipe(io.RawIOBase):
+    """ A non-seekable stream """
+
+    def __init__(self, data=b""):
+        self._data = io.BytesIO(data)
+        self.written = io.BytesIO()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        return self._data.readinto(b)
+
+    def write(self, b):
+        return self.written.write(b)
+
+
+def test_tar_stream(tmpdir, tree, monkeypatch):
+    monkeypatch.setattr(_backup.TarBackup, "CHUNK_SIZE", 1000)
+    pipe = _Pipe()
+    with backup("tar", pipe, "w", codec="store") as b:
+        b.addtree(tree, "filestore")
+        b.write(io.BytesIO(TEXT), "dump.sql")
+        b.write(io.BytesIO(b""), "empty")
+    assert not pipe.seekable()
+    dest = str(tmpdir / "restored")
+    with backup("tar", _Pipe(pipe.written.getvalue()), "r") as b:
+        b.extractall(dest)
+    with open(os.path.join(dest, "filestore", "image"), "rb") as f:
+        assert f.read() == JPEG
+    with open(os.path.join(dest, "dump.sql"), "rb") as f:
+        assert f.read() == TEXT
+    assert os.path.getsize(os.path.join(dest, "empty")) == 0
+
+
+@pytest.mark.parametrize("codec", ["store", "zstd", "lz4"])
+def test_tar_detect_codec(tmpdir, tree, codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    elif codec == "lz4":
+        pytest.importorskip("lz4.frame")
+    pipe = _Pipe()
+    with backup("tar", pipe, "w", codec=codec) as b:
+        b.addtree(tree, "filestore")
+    dest = str(tmpdir / "restored")
+    # the reader is not told the codec
+    with backup("tar", _Pipe(pipe.written.getvalue()), "r") as b:
+        b.extractall(dest)
+    with open(os.path.join(dest, "filestore", "text"), "rb") as f:
+        assert f.read() == TEXT
+
+
+def test_tar_extract_outside(tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        info = tarfile.TarInfo("../evil")
+        tar.addfile(info, io.BytesIO())
+    data.seek(0)
+    with pytest.raises(Exception):
+        with backup("tar", data, "r") as b:
+            b.extractall(str(tmpdir / "restored"))
+    assert not os.path.exists(str(tmpdir / "evil"))
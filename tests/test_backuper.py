@@ -1,9 +1,12 @@
 # Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
 
+import io
+import json
 import os
 import shutil
 import subprocess
+import zipfile
 from filecmp import dircmp
 
 import pytest
@@ -11,6 +14,7 @@ from click.testing import CliRunner
 from dodoo import odoo
 
 from dodoo_dbhandler import backuper
+from dodoo_dbhandler._backup import backup as do_backup
 from dodoo_dbhandler._dbutils import db_exists
 
 TEST_DBNAME = "dodoo-cruder-testbackupdb"
@@ -104,6 +108,110 @@ def tests_backupdb_folder(pgdb, filestore, tmp_path, manifest):
     _check_backup(backup_dir)
 
 
+def tests_backupdb_directory_format(pgdb, filestore, tmp_path, manifest):
+    backup_dir = tmp_path.joinpath("backup3").as_posix()
+    result = CliRunner().invoke(
+        backuper.snapshot,
+        ["--dump-format", "directory", "--dump-jobs", "2", TEST_DBNAME, backup_dir],
+    )
+    assert result.exit_code == 0, result.output
+    latest = backuper._latest_snapshot(backup_dir)
+    # pg_dump writes a table of contents in the dump directory
+    assert os.path.exists(os.path.join(latest, "db.dir", "toc.dat"))
+    with open(os.path.join(latest, "manifest.json")) as f:
+        manifest = json.load(f)
+    assert manifest["dump_format"] == "directory"
+    assert manifest["dump_file"] == "db.dir"
+
+
+def tests_backupdb_direct(pgdb, filestore, tmp_path, manifest, mocker):
+    mocker.patch.object(
+        backuper,
+        "_snapshot_date",
+        side_effect=["2019-01-01T00_00_00", "2019-01-02T00_00_00"],
+    )
+    backup_dir = tmp_path.joinpath("backup4").as_posix()
+    new_file = os.path.join(odoo.tools.config.filestore(TEST_DBNAME), "dir2", "g.txt")
+    for _i in range(2):
+        result = CliRunner().invoke(
+            backuper.snapshot, ["--direct", TEST_DBNAME, backup_dir]
+        )
+        assert result.exit_code == 0, result.output
+        _check_backup(backup_dir)
+        os.makedirs(os.path.dirname(new_file), exist_ok=True)
+        with open(new_file, "w") as f:
+            f.write("New file")
+    assert not os.path.exists(os.path.join(backup_dir, "incomplete.snapshot"))
+    first, second = [
+        os.path.join(backup_dir, "2019-01-0{}T00_00_00.snapshot".format(i), "filestore")
+        for i in (1, 2)
+    ]
+    # unchanged files are shared, new ones copied
+    assert os.path.samefile(
+        os.path.join(first, *TEST_FILESTORE_FILE.split("/")[1:]),
+        os.path.join(second, *TEST_FILESTORE_FILE.split("/")[1:]),
+    )
+    assert not os.path.exists(os.path.join(first, "dir2", "g.txt"))
+    assert os.path.exists(os.path.join(second, "dir2", "g.txt"))
+
+
+def tests_backupdb_direct_rotate(pgdb, tmp_path, manifest, mocker):
+    dates = ["2019-01-0{}T00_00_00".format(i) for i in (1, 2, 3)]
+    mocker.patch.object(backuper, "_snapshot_date", side_effect=dates)
+    backup_dir = tmp_path.joinpath("backup5").as_posix()
+    options = ["--direct", "--min-snapshots", "1", "--max-snapshots", "2"]
+    for _date in dates:
+        result = CliRunner().invoke(
+            backuper.snapshot, options + [TEST_DBNAME, backup_dir]
+        )
+        assert result.exit_code == 0, result.output
+    assert sorted(os.listdir(backup_dir)) == [
+        "2019-01-02T00_00_00.snapshot",
+        "2019-01-03T00_00_00.snapshot",
+        "latest.snapshot",
+    ]
+    latest = os.path.join(backup_dir, "latest.snapshot")
+    assert os.readlink(latest) == "2019-01-03T00_00_00.snapshot"
+
+
+def tests_backupdb_stream(pgdb, filestore, tmp_path, manifest):
+    archive = tmp_path.joinpath("backup.tar").as_posix()
+    result = CliRunner().invoke(backuper.snapshot, ["--stream", TEST_DBNAME, archive])
+    assert result.exit_code == 0, result.output
+    restored = tmp_path.joinpath("restored").as_posix()
+    with do_backup("tar", archive, "r") as _backup:
+        _backup.extractall(restored)
+    assert os.path.exists(os.path.join(restored, "db.dump"))
+    assert os.path.exists(
+        os.path.join(restored, "filestore", *TEST_FILESTORE_FILE.split("/")[1:])
+    )
+    with open(os.path.join(restored, "manifest.json")) as f:
+        assert json.load(f)["dump_format"] == "custom"
+
+
+@pytest.mark.parametrize(
+    "options", [["--stream", "--direct"], ["--codec", "zstd"], ["--level", "1"]]
+)
+def tests_backupdb_stream_options(pgdb, tmp_path, options):
+    dest = tmp_path.joinpath("backup").as_posix()
+    result = CliRunner().invoke(backuper.snapshot, options + [TEST_DBNAME, dest])
+    assert result.exit_code != 0
+    assert not os.path.exists(dest)
+
+
+def tests_zip_backup_write(tmp_path, mocker, manifest):
+    tempfile = mocker.patch("tempfile.NamedTemporaryFile")
+    path = tmp_path.joinpath("backup.zip").as_posix()
+    with do_backup("zip", path, "w") as _backup:
+        backuper._create_manifest(None, TEST_DBNAME, _backup)
+        _backup.write(io.BytesIO(b"-- dump"), "dump.sql")
+    assert not tempfile.called
+    with zipfile.ZipFile(path) as z:
+        assert z.read("dump.sql") == b"-- dump"
+        manifest = json.loads(z.read("manifest.json").decode("utf8"))
+    assert manifest["dump_format"] == "plain"
+
+
 def tests_backupdb_not_exists():
     assert not db_exists(TEST_DBNAME)
     result = CliRunner().invoke(backuper.snapshot, [TEST_DBNAME, "out"])
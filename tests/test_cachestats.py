@@ -0,0 +1,73 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import json
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from dodoo_dbhandler._metrics import Metrics, aggregate, read_json
+from dodoo_dbhandler.cachestats import cachestats
+from dodoo_dbhandler.initializer import DbCache
+
+TEST_DBNAME = "dodoo-initializer-testcachestatsdb"
+TEST_PREFIX = "tstpfx8"
+TEST_HASH = "a" * DbCache.HASH_SIZE
+
+
+@pytest.fixture
+def dbcache():
+    subprocess.check_call(["createdb", TEST_DBNAME])
+    try:
+        with DbCache(TEST_PREFIX) as c:
+            try:
+                yield c
+            finally:
+                c.purge()
+    finally:
+        subprocess.check_call(["dropdb", "--if-exists", TEST_DBNAME])
+
+
+def test_metrics_aggregate(tmpdir):
+    metrics_file = str(tmpdir / "metrics.jsonl")
+    miss = Metrics(TEST_PREFIX)
+    miss.set(hit=False, miss_reason="evicted")
+    with miss.timer("build"):
+        pass
+    miss.write_json(metrics_file)
+    hit = Metrics(TEST_PREFIX)
+    hit.set(hit=True, time_saved=10.0)
+    hit.write_json(metrics_file)
+    # trim only runs do not count
+    Metrics(TEST_PREFIX).write_json(metrics_file)
+    with open(metrics_file, "a") as f:
+        f.write("garbage\n")
+    res = aggregate(read_json(metrics_file))
+    assert res["runs"] == 2
+    assert res["hits"] == 1
+    assert res["hit_ratio"] == 0.5
+    assert res["miss_reasons"]["evicted"] == 1
+    assert res["miss_reasons"]["new_hash"] == 0
+    assert res["time_saved"] == 10.0
+    assert res["timings"]["build"] >= 0
+
+
+def test_cachestats_cmd(dbcache, tmpdir):
+    dbcache.add(TEST_DBNAME, TEST_HASH, build_duration=60.0)
+    metrics_file = str(tmpdir / "metrics.jsonl")
+    metrics = Metrics(TEST_PREFIX)
+    metrics.set(hit=True, time_saved=55.0)
+    metrics.write_json(metrics_file)
+    result = CliRunner().invoke(
+        cachestats,
+        ["--cache-prefix", TEST_PREFIX, "--metrics-file", metrics_file, "--json"],
+    )
+    assert result.exit_code == 0, result.output
+    res = json.loads(result.output)
+    assert res["catalog"][TEST_PREFIX]["templates"] == 1
+    assert res["catalog"][TEST_PREFIX]["build_duration"] == 60.0
+    assert res["runs"]["hits"] == 1
+    result = CliRunner().invoke(cachestats, ["--cache-prefix", TEST_PREFIX])
+    assert result.exit_code == 0, result.output
+    assert "Templates of prefix {}".format(TEST_PREFIX) in result.output
@@ -4,17 +4,30 @@
 import os
 import shutil
 import subprocess
+import threading
 
 import dodoo
 import pytest
 from click.testing import CliRunner
 from dodoo import odoo
 
-from dodoo_dbhandler._dbutils import db_exists
-from dodoo_dbhandler.copier import copy
+from dodoo_dbhandler import copier
+from dodoo_dbhandler._clone import select_engine
+from dodoo_dbhandler._dbutils import db_exists, pg_connect
+from dodoo_dbhandler._filestore import CopyStopped
+from dodoo_dbhandler.copier import (
+    _copy_db,
+    _copy_filestore,
+    _missing_modules,
+    copy,
+    derived_hashsum,
+)
+from dodoo_dbhandler.initializer import DbCache
 
 TEST_DBNAME = "dodoo-cruder-testcopydb"
 TEST_DBNAME_NEW = "dodoo-cruder-testcopydb-new"
+TEST_CACHE_PREFIX = "tstcopy"
+TEST_DBNAMES_FANOUT = ["dodoo-cruder-testcopydb-new2", "dodoo-cruder-testcopydb-new3"]
 
 
 def _dropdb(dbname):
@@ -95,6 +108,86 @@ def tests_module_install_and_raw_sql(pgdb, filestore, mocker):
             shutil.rmtree(filestore_dir_new)
 
 
+def test_missing_modules(pgdb):
+    with pg_connect(TEST_DBNAME) as cr:
+        cr.execute("CREATE TABLE ir_module_module (name VARCHAR, state VARCHAR)")
+        cr.execute(
+            "INSERT INTO ir_module_module VALUES "
+            "('base', 'installed'), ('web', 'to upgrade'), "
+            "('auth_signup', 'uninstalled')"
+        )
+    missing = _missing_modules(TEST_DBNAME, {"base", "web", "auth_signup", "mail"})
+    assert missing == ["auth_signup", "mail"]
+
+
+def test_copydb_modules_installed(pgdb, mocker):
+    mocker.patch.object(copier, "_missing_modules", return_value=[])
+    registry_new = mocker.patch.object(odoo.modules.registry.Registry, "new")
+    try:
+        result = CliRunner().invoke(
+            copy, ["--modules", "base", TEST_DBNAME, TEST_DBNAME_NEW]
+        )
+        assert result.exit_code == 0, result.output
+        assert "All 1 modules already installed" in result.output
+        assert not registry_new.called
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_derived_hashsum(pgdb):
+    hashsum = derived_hashsum(TEST_DBNAME, "v1", ["base"])
+    assert len(hashsum) == DbCache.HASH_SIZE
+    assert hashsum == derived_hashsum(TEST_DBNAME, "v1", ["base"])
+    assert hashsum != derived_hashsum(TEST_DBNAME, "v2", ["base"])
+    assert hashsum != derived_hashsum(TEST_DBNAME, "v1", ["web"])
+
+
+def test_copydb_cache(pgdb, mocker):
+    install_modules = mocker.patch.object(copier, "_install_modules")
+    dbnames = [TEST_DBNAME_NEW] + TEST_DBNAMES_FANOUT[:1]
+    try:
+        for dbname in dbnames:
+            result = CliRunner().invoke(
+                copy,
+                [
+                    "--cache",
+                    "--cache-prefix",
+                    TEST_CACHE_PREFIX,
+                    "--source-version",
+                    "v1",
+                    "--modules",
+                    "base",
+                    TEST_DBNAME,
+                    dbname,
+                ],
+            )
+            assert result.exit_code == 0, result.output
+            assert db_exists(dbname)
+        # the second copy was cloned from the cache
+        assert install_modules.call_count == 1
+        with DbCache(TEST_CACHE_PREFIX) as dbcache:
+            assert dbcache.size == 1
+    finally:
+        with DbCache(TEST_CACHE_PREFIX) as dbcache:
+            dbcache.purge()
+        for dbname in dbnames:
+            _dropdb(dbname)
+
+
+def test_copydb_cache_requires_version(pgdb):
+    result = CliRunner().invoke(
+        copy, ["--cache", "--modules", "base", TEST_DBNAME, TEST_DBNAME_NEW]
+    )
+    assert result.exit_code != 0
+    assert "--cache requires --source-version" in result.output
+    result = CliRunner().invoke(
+        copy, ["--cache", "--source-version", "v1", TEST_DBNAME, TEST_DBNAME_NEW]
+    )
+    assert result.exit_code != 0
+    assert "--cache requires --modules" in result.output
+    assert not db_exists(TEST_DBNAME_NEW)
+
+
 def tests_copydb_template_absent():
     assert not db_exists(TEST_DBNAME)
     assert not db_exists(TEST_DBNAME_NEW)
@@ -115,6 +208,59 @@ def test_copydb_target_exists(pgdb):
         _dropdb(TEST_DBNAME_NEW)
 
 
+def test_copydb_fanout(pgdb, filestore):
+    source_dir = os.path.join(odoo.tools.config.filestore(TEST_DBNAME), "ab")
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, "abcd"), "w") as f:
+        f.write("content")
+    dbnames = [TEST_DBNAME_NEW] + TEST_DBNAMES_FANOUT
+    try:
+        args = ["--force-disconnect", "--copy-jobs", "2"]
+        for dbname in TEST_DBNAMES_FANOUT:
+            args.extend(["--dest", dbname])
+        result = CliRunner().invoke(copy, args + [TEST_DBNAME, TEST_DBNAME_NEW])
+        assert result.exit_code == 0, result.output
+        first_file = os.path.join(
+            odoo.tools.config.filestore(TEST_DBNAME_NEW), "ab", "abcd"
+        )
+        for dbname in TEST_DBNAMES_FANOUT:
+            assert db_exists(dbname)
+            new_file = os.path.join(odoo.tools.config.filestore(dbname), "ab", "abcd")
+            assert os.path.samefile(new_file, first_file)
+    finally:
+        for dbname in dbnames:
+            _dropdb(dbname)
+            shutil.rmtree(odoo.tools.config.filestore(dbname), ignore_errors=True)
+
+
+def test_copydb_fanout_checks(pgdb):
+    _createdb(TEST_DBNAMES_FANOUT[1])
+    try:
+        result = CliRunner().invoke(
+            copy, ["--dest", TEST_DBNAME_NEW, TEST_DBNAME, TEST_DBNAME_NEW]
+        )
+        assert result.exit_code != 0
+        assert "Duplicate destination database names" in result.output
+        result = CliRunner().invoke(
+            copy,
+            [
+                "--dest",
+                TEST_DBNAMES_FANOUT[0],
+                "--dest",
+                TEST_DBNAMES_FANOUT[1],
+                TEST_DBNAME,
+                TEST_DBNAME_NEW,
+            ],
+        )
+        assert result.exit_code != 0
+        assert "Destination database already exists" in result.output
+        # nothing was copied
+        assert not db_exists(TEST_DBNAME_NEW)
+        assert not db_exists(TEST_DBNAMES_FANOUT[0])
+    finally:
+        _dropdb(TEST_DBNAMES_FANOUT[1])
+
+
 def test_copydb_no_source_filestore(pgdb):
     filestore_dir_new = odoo.tools.config.filestore(TEST_DBNAME_NEW)
     try:
@@ -127,3 +273,86 @@ def test_copydb_no_source_filestore(pgdb):
         assert not os.path.isdir(filestore_dir_new)
     finally:
         _dropdb(TEST_DBNAME_NEW)
+
+
+@pytest.mark.parametrize("engine", ["auto", "template", "dump"])
+def test_copydb_clone_engine(pgdb, engine):
+    try:
+        with pg_connect() as cr:
+            _copy_db(cr, TEST_DBNAME, TEST_DBNAME_NEW, engine)
+        assert db_exists(TEST_DBNAME_NEW)
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_select_engine(pgdb):
+    with pg_connect() as cr:
+        if cr.connection.server_version >= 150000:
+            # small database
+            assert select_engine(cr, TEST_DBNAME) == "wal_log"
+            assert select_engine(cr, TEST_DBNAME, "file_copy") == "file_copy"
+        else:
+            assert select_engine(cr, TEST_DBNAME) == "template"
+            assert select_engine(cr, TEST_DBNAME, "file_copy") == "template"
+        assert select_engine(cr, TEST_DBNAME, "dump") == "dump"
+
+
+@pytest.mark.parametrize("mode", ["auto", "hardlink", "reflink", "parallel", "copy"])
+def test_copy_filestore_modes(filestore, mode):
+    source_dir = os.path.join(odoo.tools.config.filestore(TEST_DBNAME), "ab")
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, "abcd"), "w") as f:
+        f.write("content")
+    filestore_dir_new = odoo.tools.config.filestore(TEST_DBNAME_NEW)
+    try:
+        _copy_filestore(TEST_DBNAME, TEST_DBNAME_NEW, mode, 2)
+        new_file = os.path.join(filestore_dir_new, "ab", "abcd")
+        with open(new_file) as f:
+            assert f.read() == "content"
+        if mode in ("auto", "hardlink"):
+            # same file system
+            assert os.path.samefile(new_file, os.path.join(source_dir, "abcd"))
+    finally:
+        shutil.rmtree(filestore_dir_new, ignore_errors=True)
+
+
+@pytest.mark.parametrize("mode", ["hardlink", "parallel", "copy"])
+def test_copy_filestore_stop(filestore, mode):
+    source_dir = os.path.join(odoo.tools.config.filestore(TEST_DBNAME), "ab")
+    os.makedirs(source_dir)
+    with open(os.path.join(source_dir, "abcd"), "w") as f:
+        f.write("content")
+    filestore_dir_new = odoo.tools.config.filestore(TEST_DBNAME_NEW)
+    stop = threading.Event()
+    stop.set()
+    try:
+        with pytest.raises(CopyStopped):
+            _copy_filestore(TEST_DBNAME, TEST_DBNAME_NEW, mode, 2, stop)
+        assert not os.path.exists(os.path.join(filestore_dir_new, "ab", "abcd"))
+    finally:
+        shutil.rmtree(filestore_dir_new, ignore_errors=True)
+
+
+def test_copy_rollback_filestore_failure(pgdb, filestore, mocker):
+    mocker.patch.object(copier, "_copy_filestore", side_effect=OSError("boom"))
+    try:
+        with pytest.raises(OSError):
+            copier._copy_db_and_filestore(
+                TEST_DBNAME, TEST_DBNAME_NEW, "auto", "auto", 2
+            )
+        assert not db_exists(TEST_DBNAME_NEW)
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_copy_rollback_db_failure(pgdb, filestore, mocker):
+    mocker.patch.object(copier, "_copy_db", side_effect=RuntimeError("boom"))
+    filestore_dir_new = odoo.tools.config.filestore(TEST_DBNAME_NEW)
+    try:
+        with pytest.raises(RuntimeError):
+            copier._copy_db_and_filestore(
+                TEST_DBNAME, TEST_DBNAME_NEW, "auto", "auto", 2
+            )
+        assert not os.path.exists(filestore_dir_new)
+    finally:
+        shutil.rmtree(filestore_dir_new, ignore_errors=True)
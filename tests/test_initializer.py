@@ -20,18 +20,28 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this library; if not, see <http://www.gnu.org/licenses/>.
 #
+import json
 import os
+import shutil
+import socket
 import subprocess
 import sys
 import textwrap
+import threading
+import time
 from datetime import datetime, timedelta
 
+import click
 import dodoo
 import mock
 import pytest
 from click.testing import CliRunner
+from dodoo import odoo
 
-from dodoo_dbhandler import initializer
+from dodoo_dbhandler import _modulelist, initializer
+from dodoo_dbhandler._dbutils import db_exists
+from dodoo_dbhandler._eviction import eviction_policy
+from dodoo_dbhandler._hashing import FingerprintCache
 
 TEST_DBNAME = "dodoo-initializer-testdb"
 TEST_DBNAME_NEW = "dodoo-initializer-testdb-new"
@@ -95,6 +105,339 @@ def test_dbcache_create(pgdb, dbcache):
         _dropdb(TEST_DBNAME_NEW)
 
 
+def test_dbcache_create_nearest(pgdb, dbcache):
+    digests = {"base": "d1", "web": "d2"}
+    dbcache.add(pgdb, TEST_HASH1, digests, False)
+    dbcache.add(pgdb, TEST_HASH2, {"base": "d1"}, False)
+    dbcache.add(pgdb, TEST_HASH3)
+    assert dbcache.size == 3
+    assert dbcache.create_nearest(TEST_DBNAME_NEW, {"base": "d3"}, False) is None
+    assert dbcache.create_nearest(TEST_DBNAME_NEW, digests, True) is None
+    try:
+        installed = dbcache.create_nearest(
+            TEST_DBNAME_NEW, dict(digests, mail="d4"), False
+        )
+        assert installed == {"base", "web"}
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    try:
+        installed = dbcache.create_nearest(
+            TEST_DBNAME_NEW, {"base": "d1", "web": "d5"}, False
+        )
+        assert installed == {"base"}
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_dbcache_create_stale(pgdb, dbcache):
+    digests = {"base": "d1", "web": "d2"}
+    dbcache.add(pgdb, TEST_HASH1, digests, False)
+    assert dbcache.create_stale(TEST_DBNAME_NEW, {"base": "d1"}, False) is None
+    assert dbcache.create_stale(TEST_DBNAME_NEW, digests, True) is None
+    try:
+        changed = dbcache.create_stale(
+            TEST_DBNAME_NEW, {"base": "d1", "web": "d3"}, False
+        )
+        assert changed == {"web"}
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_dbcache_spares(pgdb, dbcache):
+    dbcache.add(pgdb, TEST_HASH1)
+    dbcache.add(pgdb, TEST_HASH2)
+    assert dbcache.refill_spares(TEST_HASH1, 2) == 2
+    assert dbcache.refill_spares(TEST_HASH1, 2) == 0
+    assert dbcache.refill_spares(TEST_HASH3, 2) == 0
+    assert len(dbcache._find_spares(TEST_HASH1)) == 2
+    # spares are not counted as templates
+    assert dbcache.size == 2
+    try:
+        assert dbcache.create(TEST_DBNAME_NEW, TEST_HASH1)
+        assert len(dbcache._find_spares(TEST_HASH1)) == 1
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    dbcache.refill_all_spares(1)
+    assert len(dbcache._find_spares(TEST_HASH2)) == 1
+    # evicting a template drops its spares
+    dbcache.trim_size(max_size=1)
+    assert dbcache.size == 1
+    assert len(dbcache._find_spares()) == 1
+
+
+def test_dbcache_filestore(pgdb, dbcache):
+    filestore = odoo.tools.config.filestore(pgdb)
+    os.makedirs(os.path.join(filestore, "ab"))
+    with open(os.path.join(filestore, "ab", "abcd"), "w") as f:
+        f.write("content")
+    new_filestore = odoo.tools.config.filestore(TEST_DBNAME_NEW)
+    try:
+        dbcache.add(pgdb, TEST_HASH1)
+        template_name = dbcache._find_template(TEST_HASH1)
+        template_file = os.path.join(
+            odoo.tools.config.filestore(template_name), "ab", "abcd"
+        )
+        assert os.path.samefile(template_file, os.path.join(filestore, "ab", "abcd"))
+        dbcache.refill_spares(TEST_HASH1, 1)
+        assert dbcache.create(TEST_DBNAME_NEW, TEST_HASH1)
+        # the spare and its filestore were renamed
+        assert os.path.samefile(
+            os.path.join(new_filestore, "ab", "abcd"), template_file
+        )
+        dbcache.pgcr.execute(
+            "SELECT filestore_size FROM {} WHERE datname = %s".format(dbcache.CATALOG),
+            (template_name,),
+        )
+        assert dbcache.pgcr.fetchone()[0] == len("content")
+        dbcache.trim_size(0)
+        assert not os.path.exists(template_file)
+        assert os.path.exists(os.path.join(new_filestore, "ab", "abcd"))
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+        shutil.rmtree(filestore, ignore_errors=True)
+        shutil.rmtree(new_filestore, ignore_errors=True)
+
+
+def test_dbcache_filestore_host(pgdb, dbcache):
+    filestore = odoo.tools.config.filestore(pgdb)
+    os.makedirs(os.path.join(filestore, "ab"))
+    with open(os.path.join(filestore, "ab", "abcd"), "w") as f:
+        f.write("content")
+    try:
+        dbcache.add(pgdb, TEST_HASH1)
+        template_name = dbcache._find_template(TEST_HASH1)
+        assert template_name
+        # a template whose filestore is on another host is a miss
+        dbcache.pgcr.execute(
+            "UPDATE {} SET filestore_host = 'elsewhere'".format(dbcache.CATALOG)
+        )
+        assert not dbcache._find_template(TEST_HASH1)
+        assert not dbcache.create(TEST_DBNAME_NEW, TEST_HASH1)
+        # and so is a template whose filestore is gone
+        dbcache.pgcr.execute(
+            "UPDATE {} SET filestore_host = %s".format(dbcache.CATALOG),
+            (socket.gethostname(),),
+        )
+        assert dbcache._find_template(TEST_HASH1) == template_name
+        shutil.rmtree(odoo.tools.config.filestore(template_name))
+        assert not dbcache._find_template(TEST_HASH1)
+    finally:
+        shutil.rmtree(filestore, ignore_errors=True)
+
+
+def test_dbcache_claim_spare_filestore_error(pgdb, dbcache, mocker):
+    dbcache.add(pgdb, TEST_HASH1)
+    dbcache.refill_spares(TEST_HASH1, 1)
+    spares = dbcache._find_spares(TEST_HASH1)
+    mocker.patch.object(initializer, "rename_filestore", side_effect=OSError)
+    try:
+        # the template is cloned, and the spare left as is
+        assert dbcache.create(TEST_DBNAME_NEW, TEST_HASH1)
+        assert dbcache._find_spares(TEST_HASH1) == spares
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_dbcache_build_lock(dbcache):
+    events = []
+
+    def wait_build():
+        with initializer.DbCache(TEST_PREFIX) as other:
+            with other.build_lock(TEST_HASH1, timeout=60):
+                events.append("waited")
+
+    with dbcache.build_lock(TEST_HASH1, timeout=60):
+        thread = threading.Thread(target=wait_build)
+        thread.start()
+        time.sleep(1)
+        events.append("built")
+    thread.join(10)
+    assert events == ["built", "waited"]
+    with dbcache.build_lock(TEST_HASH1, timeout=60):
+        with initializer.DbCache(TEST_PREFIX) as other:
+            with pytest.raises(click.ClickException):
+                with other.build_lock(TEST_HASH1, timeout=1):
+                    pass
+
+
+def test_dbcache_build_lock_failed_build(dbcache):
+    """ When the build fails, a single waiting process builds the
+    template, and the other one uses it """
+    built = []
+
+    def wait_build():
+        with initializer.DbCache(TEST_PREFIX) as other:
+            with other.build_lock(TEST_HASH1, timeout=60):
+                if not built:
+                    time.sleep(1)
+                    built.append(threading.current_thread().name)
+
+    threads = [threading.Thread(target=wait_build) for _i in range(2)]
+    with pytest.raises(ZeroDivisionError):
+        with dbcache.build_lock(TEST_HASH1, timeout=60):
+            for thread in threads:
+                thread.start()
+            time.sleep(1)
+            1 / 0
+    for thread in threads:
+        thread.join(10)
+    assert len(built) == 1
+
+
+def test_dbcache_catalog_migration(pgdb, dbcache):
+    template_name = dbcache._make_pattern(dt=TODAY_MINUS_4, hs=TEST_HASH1)
+    subprocess.check_call(["createdb", "-T", pgdb, template_name])
+    try:
+        with initializer.DbCache(TEST_PREFIX) as other:
+            assert other.size == 1
+            assert other._find_template(TEST_HASH1) == template_name
+            other.trim_age(timedelta(days=3))
+            assert other.size == 0
+    finally:
+        _dropdb(template_name)
+
+
+def test_dbcache_catalog_usage(pgdb, dbcache):
+    dbcache.add(pgdb, TEST_HASH1, {"base": "d1"}, False, 42.0)
+    try:
+        assert dbcache.create(TEST_DBNAME_NEW, TEST_HASH1)
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    dbcache.pgcr.execute(
+        "SELECT hit_count, build_duration, size, demo FROM {} "
+        "WHERE prefix = %s".format(dbcache.CATALOG),
+        (TEST_PREFIX,),
+    )
+    hit_count, build_duration, size, demo = dbcache.pgcr.fetchone()
+    assert hit_count == 1
+    assert build_duration == 42.0
+    assert size > 0
+    assert demo is False
+
+
+def test_dbcache_miss_reason(pgdb, dbcache):
+    dbcache.add(pgdb, TEST_HASH1, {"base": "d1"}, False)
+    reason = dbcache.miss_reason(TEST_HASH2, {"base": "d2"}, False)
+    assert reason == "new_hash"
+    reason = dbcache.miss_reason(TEST_HASH2, {"base": "d1", "web": "d3"}, False)
+    assert reason == "new_module_set"
+    dbcache.trim_size(0)
+    assert dbcache.miss_reason(TEST_HASH1, {"base": "d1"}, False) == "evicted"
+
+
+def test_create_cmd_metrics(dbcache, tmpdir):
+    metrics_file = tmpdir / "metrics.jsonl"
+    metrics_prom = tmpdir / "metrics.prom"
+    args = [
+        "--cache-prefix",
+        TEST_PREFIX,
+        "-n",
+        TEST_DBNAME_NEW,
+        "-m",
+        "base",
+        "--metrics-file",
+        str(metrics_file),
+        "--metrics-prom",
+        str(metrics_prom),
+    ]
+    try:
+        with mock.patch.object(initializer, "module_digests") as m:
+            for _i in range(2):
+                result = CliRunner().invoke(initializer.init, args)
+                assert result.exit_code == 0, result.output
+                _dropdb(TEST_DBNAME_NEW)
+            # legacy checksums do not need per-module digests on misses
+            assert m.call_count == 0
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    miss, hit = [json.loads(line) for line in metrics_file.readlines()]
+    assert miss["hit"] is False
+    assert miss["miss_reason"] == "new_module_set"
+    assert miss["timings"]["build"] > 0
+    assert hit["hit"] is True
+    assert hit["template_size"] > 0
+    assert hit["time_saved"] > 0
+    assert "build" not in hit["timings"]
+    prom = metrics_prom.read()
+    assert 'dodoo_init_hit{{prefix="{}"}} 1.0'.format(TEST_PREFIX) in prom
+    assert 'phase="refresh"' in prom
+
+
+def test_create_cmd_profile(dbcache, tmpdir):
+    profile = tmpdir / "profile.txt"
+    try:
+        result = CliRunner().invoke(
+            initializer.init,
+            [
+                "--cache-prefix",
+                TEST_PREFIX,
+                "-n",
+                TEST_DBNAME_NEW,
+                "-m",
+                "base",
+                "--profile",
+                str(profile),
+            ],
+        )
+        assert result.exit_code == 0, result.output
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    report = profile.read()
+    assert "registry load {}".format(TEST_DBNAME_NEW) in report
+    assert "[lock]" in report
+    assert "lock wait:" in report
+
+
+def test_dbcache_trim_size_policies(pgdb, dbcache):
+    dbcache.add(pgdb, TEST_HASH1, build_duration=2400)
+    dbcache.add(pgdb, TEST_HASH2, build_duration=120)
+    for _i in range(2):
+        assert dbcache.create(TEST_DBNAME_NEW, TEST_HASH2)
+        _dropdb(TEST_DBNAME_NEW)
+    dbcache.add(pgdb, TEST_HASH3, build_duration=60)
+    # HASH3 is the most recently used, HASH2 the most frequently used
+    # and HASH1 the most expensive to rebuild
+    dbcache.trim_size(2, eviction_policy("cost"))
+    assert dbcache._find_template(TEST_HASH1)
+    dbcache.trim_size(1, eviction_policy("lfu"))
+    assert dbcache.size == 1
+    assert dbcache._find_template(TEST_HASH2)
+
+
+def test_dbcache_trim_bytes(pgdb, dbcache):
+    dbcache.add(pgdb, TEST_HASH1)
+    dbcache.add(pgdb, TEST_HASH2)
+    dbcache.refill_spares(TEST_HASH2, 1)
+    dbcache.pgcr.execute("SELECT pg_database_size(%s)", (pgdb,))
+    db_size = dbcache.pgcr.fetchone()[0]
+    dbcache.trim_bytes(int(db_size * 3.5))
+    assert dbcache.size == 2
+    # HASH2 and its spare use twice the size of a database
+    dbcache.trim_bytes(int(db_size * 2.5))
+    assert dbcache.size == 1
+    assert dbcache._find_template(TEST_HASH2)
+    assert dbcache._find_spares(TEST_HASH2)
+    dbcache.trim_bytes(0)
+    assert dbcache.size == 0
+    assert not dbcache._find_spares()
+
+
+def test_dbcache_trim_bytes_catalog_lock(pgdb, dbcache, mocker):
+    dbcache.add(pgdb, TEST_HASH1)
+    drop_template = dbcache._drop_template
+
+    def _drop_template(*args):
+        # the catalog is not locked while dropping templates
+        with initializer.DbCache(TEST_PREFIX) as other:
+            assert other._try_lock(other.catalog_lock_id)
+            other._unlock(other.catalog_lock_id)
+        return drop_template(*args)
+
+    mocker.patch.object(dbcache, "_drop_template", side_effect=_drop_template)
+    dbcache.trim_bytes(0)
+    assert dbcache.size == 0
+
+
 def test_dbcache_purge(pgdb, dbcache):
     assert dbcache.size == 0
     dbcache.add(pgdb, TEST_HASH1)
@@ -305,6 +648,89 @@ def test_create_cmd_cache(dbcache, tmpdir, mocker):
     initializer.init.database = False
 
 
+def test_create_cmd_reuse_nearest(dbcache):
+    args = ["--cache-prefix", TEST_PREFIX, "-n", TEST_DBNAME_NEW]
+    try:
+        result = CliRunner().invoke(initializer.init, args + ["-m", "base_setup"])
+        assert result.exit_code == 0, result.output
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    try:
+        with mock.patch.object(initializer, "odoo_createdb") as createdb:
+            with mock.patch.object(
+                initializer, "odoo_install", wraps=initializer.odoo_install
+            ) as install:
+                result = CliRunner().invoke(
+                    initializer.init,
+                    args + ["--cache-reuse-nearest", "-m", "auth_signup"],
+                )
+                assert result.exit_code == 0, result.output
+        assert createdb.call_count == 0
+        assert install.call_count == 1
+        # the modules of the base_setup template are not installed again
+        assert "base_setup" not in install.call_args[0][2]
+        assert "auth_signup" in install.call_args[0][2]
+        assert dbcache.size == 2
+        with initializer.pg_connect(TEST_DBNAME_NEW) as cr:
+            cr.execute("SELECT state FROM ir_module_module WHERE name = 'auth_signup'")
+            assert cr.fetchone()[0] == "installed"
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
+def test_create_cmd_module_list(dbcache):
+    args = ["--cache-prefix", TEST_PREFIX, "-n", TEST_DBNAME_NEW, "-m", "auth_signup"]
+    try:
+        result = CliRunner().invoke(initializer.init, args)
+        assert result.exit_code == 0, result.output
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+    try:
+        with mock.patch.object(initializer, "update_module_list") as m1:
+            with mock.patch.object(initializer, "refresh_module_list") as m2:
+                result = CliRunner().invoke(initializer.init, args)
+                assert result.exit_code == 0, result.output
+                # the addons path did not change
+                assert m1.call_count == 0
+                assert m2.call_count == 0
+        with initializer.pg_connect(TEST_DBNAME_NEW) as cr:
+            cr.execute(
+                "UPDATE ir_module_module "
+                "SET author = 'x', website = 'y', license = 'z', sequence = -1 "
+                "WHERE name = 'auth_signup'"
+            )
+            cr.execute(
+                "DELETE FROM ir_module_module_dependency WHERE module_id IN "
+                "(SELECT id FROM ir_module_module WHERE name = 'auth_signup')"
+            )
+        with mock.patch.object(initializer, "refresh_module_list") as m:
+            initializer.update_module_list(TEST_DBNAME_NEW)
+            assert m.call_count == 0
+        with initializer.pg_connect(TEST_DBNAME_NEW) as cr:
+            # each column gets its own value back
+            expected = _modulelist._module_values(
+                _modulelist._read_manifests()["auth_signup"]
+            )
+            cr.execute(
+                "SELECT author, website, license, sequence FROM ir_module_module "
+                "WHERE name = 'auth_signup'"
+            )
+            assert cr.fetchone() == (
+                expected["author"],
+                expected["website"],
+                expected["license"],
+                expected["sequence"],
+            )
+            cr.execute(
+                "SELECT d.name FROM ir_module_module_dependency d "
+                "JOIN ir_module_module m ON m.id = d.module_id "
+                "WHERE m.name = 'auth_signup'"
+            )
+            assert "base_setup" in {r[0] for r in cr.fetchall()}
+    finally:
+        _dropdb(TEST_DBNAME_NEW)
+
+
 def test_create_cmd_nocache(dbcache, mocker):
     assert dbcache.size == 0
     try:
@@ -362,3 +788,112 @@ def test_dbcache_add_concurrency(pgdb, dbcache):
     assert dbcache.size == 1
     dbcache.add(pgdb, TEST_HASH1)
     assert dbcache.size == 1
+
+
+def test_fingerprint_cache(tmpdir):
+    store = str(tmpdir / "fingerprints.json")
+    f1 = tmpdir / "f1.txt"
+    f1.write("hello")
+    # make it old enough to be remembered
+    os.utime(str(f1), (0, 0))
+    with FingerprintCache(store) as fingerprints:
+        d1 = fingerprints.digest(str(f1))
+        assert fingerprints.digest(str(f1)) == d1
+        assert (fingerprints.hits, fingerprints.misses) == (1, 1)
+    with FingerprintCache(store) as fingerprints:
+        assert fingerprints.digest(str(f1)) == d1
+        assert (fingerprints.hits, fingerprints.misses) == (1, 0)
+        f1.write("world")
+        os.utime(str(f1), (1, 1))
+        assert fingerprints.digest(str(f1)) != d1
+        assert (fingerprints.hits, fingerprints.misses) == (1, 1)
+
+
+def test_addons_hash_fingerprints(tmpdir):
+    store = str(tmpdir / "fingerprints.json")
+    with FingerprintCache(store) as fingerprints:
+        h1 = initializer.addons_hash(["base"], False, fingerprints)
+        assert fingerprints.misses > 0
+    with FingerprintCache(store) as fingerprints:
+        h2 = initializer.addons_hash(["base"], False, fingerprints)
+        assert fingerprints.misses == 0
+    assert h1 == h2
+    assert h1 != initializer.addons_hash(["base"], True, fingerprints)
+
+
+def test_addons_hash_modular():
+    h1 = initializer.addons_hash(["base"], False, algorithm="sha1", jobs=1)
+    h2 = initializer.addons_hash(["base"], False, algorithm="sha1", jobs=4)
+    assert h1 == h2
+    assert len(h1) == initializer.DbCache.HASH_SIZE
+    assert h1 != initializer.addons_hash(["base"], False)
+    if "blake2b" in initializer.HASH_ALGORITHMS:
+        h3 = initializer.addons_hash(["base"], False, algorithm="blake2b", jobs=4)
+        assert h3 != h1
+        assert len(h3) == initializer.DbCache.HASH_SIZE
+
+
+def test_addons_hash_git(mocker):
+    h1 = initializer.addons_hash(["base"], False, git=True)
+    assert h1 == initializer.addons_hash(["base"], False, git=True)
+    # without git work tree, git fingerprints fall back to file hashing
+    mocker.patch.object(initializer.gitutils, "get_toplevel", return_value=None)
+    assert initializer.addons_hash(
+        ["base"], False, git=True
+    ) == initializer.addons_hash(["base"], False, algorithm="sha1")
+
+
+def test_git_digests_ignored(tmpdir):
+    subprocess.check_call(["git", "init"], cwd=str(tmpdir))
+    module = tmpdir / "module1"
+    module.join("__init__.py").ensure(file=True)
+    tmpdir.join(".gitignore").write("*.pyc\n*.css\n")
+    subprocess.check_call(["git", "add", "."], cwd=str(tmpdir))
+    subprocess.check_call(
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-m", "m"],
+        cwd=str(tmpdir),
+    )
+    assert str(module) in initializer._git_digests([str(module)])
+    # ignored files excluded from hashing do not matter
+    module.join("__init__.pyc").ensure(file=True)
+    assert str(module) in initializer._git_digests([str(module)])
+    # other ignored files are hashed, so the tree id is not enough
+    module.join("style.css").ensure(file=True)
+    assert str(module) not in initializer._git_digests([str(module)])
+
+
+def test_expand_new_databases():
+    assert initializer._expand_new_databases(("a", "b"), None) == ["a", "b"]
+    assert initializer._expand_new_databases(("a-{}",), 2) == ["a-1", "a-2"]
+    with pytest.raises(click.BadParameter):
+        initializer._expand_new_databases(("a",), 2)
+    for pattern in ("a-{}-{}", "a-{0}", "a-{}-{", "a-{}}"):
+        with pytest.raises(click.BadParameter):
+            initializer._expand_new_databases((pattern,), 2)
+    with pytest.raises(click.ClickException):
+        initializer._expand_new_databases(("a", "a"), None)
+
+
+def test_create_cmd_count(dbcache):
+    new_databases = [TEST_DBNAME_NEW + "-1", TEST_DBNAME_NEW + "-2"]
+    try:
+        result = CliRunner().invoke(
+            initializer.init,
+            [
+                "--cache-prefix",
+                TEST_PREFIX,
+                "-n",
+                TEST_DBNAME_NEW + "-{}",
+                "--count",
+                "2",
+                "-m",
+                "base",
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert dbcache.size == 1
+        for new_database in new_databases:
+            assert db_exists(new_database)
+    finally:
+        for new_database in new_databases:
+            _dropdb(new_database)
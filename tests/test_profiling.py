@@ -0,0 +1,47 @@
+# Copyright 2018 ACSONE SA/NV (<http://acsone.eu>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import io
+import pstats
+
+from dodoo_dbhandler import _profiling
+
+
+def test_profile(tmpdir):
+    report = str(tmpdir / "profile.txt")
+    pstats_path = str(tmpdir / "profile.pstats")
+    with _profiling.profile(report, pstats_path) as profiler:
+        with _profiling.span("outer") as span:
+            span.add(rows=3)
+            with _profiling.lock_wait("some lock"):
+                pass
+            with _profiling.span("inner", bytes=10) as span:
+                reader = _profiling.CountingReader(io.BytesIO(b"abcd"), span)
+                assert reader.read(3) == b"abc"
+                assert reader.read() == b"d"
+    assert not _profiling.enabled()
+    outer, lock, inner = profiler.spans
+    assert outer.counters == {"rows": 3}
+    assert lock.kind == _profiling.LOCK
+    assert lock.depth == inner.depth == 1
+    assert inner.counters == {"bytes": 14}
+    assert profiler.lock_wait() == lock.duration
+    with open(report) as f:
+        content = f.read()
+    assert "  some lock [lock]" in content
+    assert "lock wait:" in content
+    pstats.Stats(pstats_path)
+
+
+def test_profile_disabled():
+    with _profiling.profile(None) as profiler:
+        assert profiler is None
+        with _profiling.span("step") as span:
+            span.add(bytes=1)
+    assert not _profiling.enabled()
+
+
+def test_tree_size(tmpdir):
+    tmpdir.join("a").write("abc")
+    tmpdir.mkdir("sub").join("b").write("de")
+    assert _profiling.tree_size(str(tmpdir)) == (5, 2)
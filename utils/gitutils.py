@@ -17,3 +17,57 @@ def commit_if_needed(paths, message, cwd="."):
         return True
     else:
         return False
+
+
+def get_toplevel(path):
+    """ Return the root of the git work tree containing path, or None """
+    cmd = ["git", "rev-parse", "--show-toplevel"]
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(
+                cmd, cwd=path, stderr=devnull, universal_newlines=True
+            )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return os.path.realpath(output.strip())
+
+
+def tree_ids(relpaths, cwd="."):
+    """ Return a {relpath: tree_id} dict of directories committed in HEAD.
+
+    relpaths are relative to the root of the work tree in cwd.
+    Directories which are not in HEAD are absent from the result.
+    """
+    cmd = ["git", "ls-tree", "-d", "-z", "--full-tree", "HEAD", "--"] + relpaths
+    output = subprocess.check_output(cmd, cwd=cwd, universal_newlines=True)
+    res = {}
+    for line in output.split("\0"):
+        if not line:
+            continue
+        info, relpath = line.split("\t", 1)
+        res[relpath] = info.split()[2]
+    return res
+
+
+def dirty_paths(relpaths, cwd=".", ignored=False):
+    """ Return the set of modified, staged or untracked files under relpaths,
+    and ignored ones too if ignored is True.
+
+    relpaths are relative to the root of the work tree in cwd,
+    and so are the returned paths.
+    """
+    cmd = ["git", "status", "--porcelain", "-z", "--untracked-files=all"]
+    if ignored:
+        cmd.append("--ignored")
+    cmd += ["--"] + [":(top)" + relpath for relpath in relpaths]
+    output = subprocess.check_output(cmd, cwd=cwd, universal_newlines=True)
+    res = set()
+    entries = iter(output.split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+        res.add(entry[3:])
+        if entry[0] in "RC":
+            # renames and copies are followed by their source path
+            res.add(next(entries))
+    return res
@@ -6,7 +6,7 @@ import subprocess
 
 import pytest
 
-from utils.gitutils import commit_if_needed
+from utils.gitutils import commit_if_needed, dirty_paths, get_toplevel, tree_ids
 
 
 @pytest.fixture
@@ -86,3 +86,34 @@ def test_commit_reldir(gitdir):
         with open(file1, "w"):
             pass
         assert commit_if_needed([file1], "msg", cwd="subdir")
+
+
+def test_tree_ids_and_dirty_paths(gitdir):
+    assert get_toplevel(str(gitdir)) == os.path.realpath(str(gitdir))
+    file1 = gitdir / "dir1" / "file1"
+    file1.ensure(file=True)
+    file2 = gitdir / "dir2" / "file2"
+    file2.ensure(file=True)
+    commit_if_needed([str(file1), str(file2)], "msg", cwd=str(gitdir))
+    ids = tree_ids(["dir1", "dir2", "dir3"], cwd=str(gitdir))
+    assert set(ids) == {"dir1", "dir2"}
+    assert dirty_paths(["dir1", "dir2"], cwd=str(gitdir)) == set()
+    file1.write("stuff")
+    (gitdir / "dir2" / "file3").ensure(file=True)
+    (gitdir / "file4").ensure(file=True)
+    assert dirty_paths(["dir1", "dir2"], cwd=str(gitdir)) == {
+        "dir1/file1",
+        "dir2/file3",
+    }
+    (gitdir / ".gitignore").write("*.log\n")
+    (gitdir / "dir1" / "file5.log").ensure(file=True)
+    assert "dir1/file5.log" not in dirty_paths(["dir1"], cwd=str(gitdir))
+    assert "dir1/file5.log" in dirty_paths(["dir1"], cwd=str(gitdir), ignored=True)
+    # tree ids reflect HEAD only
+    assert tree_ids(["dir1"], cwd=str(gitdir)) == {"dir1": ids["dir1"]}
+    commit_if_needed([str(file1)], "msg", cwd=str(gitdir))
+    assert tree_ids(["dir1"], cwd=str(gitdir))["dir1"] != ids["dir1"]
+
+
+def test_get_toplevel_not_git(tmpdir):
+    assert get_toplevel(str(tmpdir)) is None